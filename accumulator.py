@@ -0,0 +1,119 @@
+import pandas as pd, numpy as np
+
+from collections import OrderedDict
+
+#--------------------------------------------------------------------------------
+# Plate accumulator
+#
+# Collecting plates in a list and concatenating them at the end holds every plate
+# twice (the list and the result), and building a frame row by row with
+# DataFrame.append copies everything on every row. Here rows are written straight
+# into one preallocated array per column, which doubles in size when full, so the
+# cost of growing is amortised and plates can be dropped as soon as they are
+# written. frame() wraps views of the filled part of the arrays without copying.
+#
+# Columns keep the dtype of the first values written to them and are widened (to
+# float for missing ints, object for text) if later values don't fit. Columns a
+# plate doesn't have are NaN (None for text) for its rows.
+
+def missing_value(dtype):
+    return None if dtype == object else np.nan
+
+def widen( dtype, values ):
+    # Smallest dtype holding both, with missing values in mind
+    if dtype == object or values.dtype == object: return np.dtype(object)
+    if values.dtype.kind in 'US': return np.dtype(object)
+    result = np.result_type(dtype, values.dtype)
+    return np.dtype(float) if result.kind in 'iub' else result
+
+class PlateAccumulator:
+    def __init__( self, columns=None, capacity=1024 ):
+        self.n        = 0
+        self.capacity = capacity
+        self.columns  = OrderedDict()
+        # Declared columns are in the frame even if nothing is ever written to them
+        for name in columns or []: self.columns[name] = np.full(capacity, np.nan)
+
+    def __len__(self):
+        return self.n
+
+    def reserve( self, n ):
+        # Make room for n rows in every column, at least doubling
+        if n <= self.capacity: return
+        capacity = max(n, 2*self.capacity)
+        for name, values in self.columns.items():
+            grown             = np.empty(capacity, dtype=values.dtype)
+            grown[:self.n]    = values[:self.n]
+            self.columns[name] = grown
+        self.capacity = capacity
+
+    def column_for( self, name, values ):
+        # The array of column name, created or widened so it can take values
+        if name not in self.columns:
+            dtype  = widen(np.dtype(float), values) if values.dtype.kind in 'iub' and self.n else values.dtype
+            dtype  = np.dtype(object) if dtype.kind in 'US' else dtype
+            column = np.empty(self.capacity, dtype=dtype)
+            if self.n: column[:self.n] = missing_value(dtype)
+            self.columns[name] = column
+        column = self.columns[name]
+
+        if not np.can_cast(values.dtype, column.dtype, casting='same_kind') or (column.dtype.kind in 'iub' and values.dtype.kind not in 'iub'):
+            column = column.astype(widen(column.dtype, values))
+            self.columns[name] = column
+        return column
+
+    def fill_missing( self, present, m ):
+        # Columns not written for the next m rows get missing values, then the rows are counted
+        for name, column in self.columns.items():
+            if name in present: continue
+            if column.dtype.kind in 'iub':
+                column = self.columns[name] = column.astype(float)
+            column[self.n:self.n+m] = missing_value(column.dtype)
+        self.n += m
+
+    def append( self, df ):
+        """
+        Write the rows of a frame (e.g. one tidied plate) after the rows already written.
+        :rtype: PlateAccumulator
+        """
+        m = len(df)
+        self.reserve(self.n + m)
+        for name in df.columns:
+            values = df[name].to_numpy()
+            self.column_for(name, values)[self.n:self.n+m] = values
+        self.fill_missing(df.columns, m)
+        return self
+
+    def append_row( self, row ):
+        """
+        Write a single row given as a dict of column -> value.
+        :rtype: PlateAccumulator
+        """
+        self.reserve(self.n + 1)
+        for name, value in row.items():
+            values = np.asarray([value])
+            self.column_for(name, values)[self.n] = value
+        self.fill_missing(row, 1)
+        return self
+
+    def column( self, name ):
+        # The filled part of a column, as a view
+        return self.columns[name][:self.n]
+
+    def frame(self):
+        """
+        All rows written so far as a DataFrame with a fresh index, sharing memory with the
+        accumulator rather than copying it.
+        :rtype: DataFrame
+        """
+        return pd.DataFrame(OrderedDict((name, self.column(name)) for name in self.columns), copy=False)
+
+def concat( frames, columns=None ):
+    """
+    Like pd.concat(frames, ignore_index=True), filling one accumulator plate by plate.
+    frames can be a generator, so each frame can be freed once it has been written.
+    :rtype: DataFrame
+    """
+    accumulator = PlateAccumulator(columns)
+    for df in frames: accumulator.append(df)
+    return accumulator.frame()
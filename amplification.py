@@ -0,0 +1,185 @@
+import pandas as pd, numpy as np
+
+#--------------------------------------------------------------------------------
+# Cq calling from raw amplification curves
+#
+# Everything here works on a fluorescence matrix F of shape (wells, cycles) so a
+# whole plate, or many plates stacked together, is processed in one go. Cycle
+# numbers returned are 1-based to match the instrument's own Cq.
+
+def read_curves(fname):
+    """
+    Reads a raw fluorescence export with one row per well: a Position column followed
+    by one column per cycle.
+    :return: Well positions and the fluorescence matrix (wells x cycles)
+    :rtype: tuple(ndarray, ndarray)
+    """
+    df = pd.read_csv(fname, header=0)
+    df.rename(columns=lambda x: x.strip(), inplace=True)
+    positions = df['Position'].astype(str).str.strip().to_numpy()
+    F         = df.drop('Position', axis=1).to_numpy(dtype=float)
+    return positions, F
+
+def masked_linear_fit( x, y, mask ):
+    # Least-squares line through the masked points of every row at once
+    n        = mask.sum(axis=1)
+    x, y     = np.where(mask, x, 0), np.where(mask, y, 0)
+    sx, sy   = x.sum(axis=1), y.sum(axis=1)
+    sxx, syy = (x*x).sum(axis=1), (y*y).sum(axis=1)
+    sxy      = (x*y).sum(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope     = (n*sxy - sx*sy)/(n*sxx - sx**2)
+        intercept = (sy - slope*sx)/n
+        r2        = (n*sxy - sx*sy)**2/((n*sxx - sx**2)*(n*syy - sy**2))
+    return slope, intercept, r2, n
+
+def second_derivative_max(F):
+    # Index of the second derivative maximum of each curve
+    return np.argmax(np.gradient(np.gradient(F, axis=1), axis=1), axis=1)
+
+def baseline_correct( F, start=2, stop=12, margin=6, min_length=8 ):
+    """
+    Subtract a straight line fitted through the baseline cycles of every well. The
+    window is cut short for early wells so it ends at least margin cycles before the
+    curve takes off, but never to fewer than min_length cycles: the second derivative
+    maximum of a flat well is just noise, and a line through a few noisy points
+    extrapolates into a drift that can cross the threshold.
+    :param ndarray F: Fluorescence (wells x cycles).
+    :param int start: First baseline cycle (0-based index).
+    :param int stop: End of the baseline window (exclusive).
+    :param int min_length: Fewest cycles in the baseline window.
+    :rtype: ndarray
+    """
+    cycles = np.arange(F.shape[1])
+    ends   = np.clip(second_derivative_max(F) - margin, min(start+min_length, stop), stop)
+    mask   = (cycles[None,:] >= start) & (cycles[None,:] < ends[:,None])
+
+    slope, intercept = masked_linear_fit(cycles[None,:], F, mask)[:2]
+    return F - (intercept[:,None] + slope[:,None]*cycles[None,:])
+
+def default_threshold( Fc, start=2, stop=12, n_sd=10 ):
+    # Threshold at n_sd standard deviations of the baseline noise of the plate. The median
+    # over wells keeps early wells, whose baseline window runs into the rise, from inflating it.
+    return n_sd*np.median(np.std(Fc[:, start:stop], axis=1))
+
+def sustained_crossing( Fc, threshold, start=2, n_above=3, min_growth=1.5 ):
+    # First cycle from which each curve stays above the threshold for n_above cycles, so
+    # noise spikes don't count as a rise, and whether it is a real rise at all: over those
+    # cycles an amplifying curve grows exponentially, a drifting baseline hardly at all.
+    above = Fc >= threshold
+    above[:, :start] = False
+
+    n_runs    = max(Fc.shape[1] - n_above + 1, 0)
+    sustained = np.ones((len(Fc), n_runs), dtype=bool)
+    for i in range(n_above): sustained &= above[:, i:i+n_runs]
+    if not n_runs: return np.zeros(len(Fc), dtype=int), np.zeros(len(Fc), dtype=bool)
+
+    first   = np.argmax(sustained, axis=1)
+    rows    = np.arange(len(Fc))
+    growing = Fc[rows, first+n_above-1] >= min_growth*Fc[rows, first]
+    return first, sustained.any(axis=1) & growing
+
+def threshold_cq( Fc, threshold, start=2, n_above=3 ):
+    """
+    Fractional cycle at which each baseline-corrected curve crosses the threshold to stay
+    above it for at least n_above cycles, interpolated linearly between the cycles either
+    side. NaN if it never does.
+    :rtype: ndarray
+    """
+    first, crossed = sustained_crossing(Fc, threshold, start, n_above)
+    first          = np.maximum(first, 1)
+    rows    = np.arange(len(Fc))
+    y0, y1  = Fc[rows, first-1], Fc[rows, first]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cq = first + (threshold-y0)/(y1-y0)
+    return np.where(crossed, cq, np.nan)
+
+def sdm_cq( Fc, threshold, start=2, n_above=3 ):
+    """
+    Cycle of the second derivative maximum of each curve, refined with a parabola
+    through the neighbouring points. NaN for wells that never rise above the threshold
+    for n_above cycles.
+    :rtype: ndarray
+    """
+    d2   = np.gradient(np.gradient(Fc, axis=1), axis=1)
+    k    = np.clip(np.argmax(d2, axis=1), 1, Fc.shape[1]-2)
+    rows = np.arange(len(Fc))
+
+    left, mid, right = d2[rows, k-1], d2[rows, k], d2[rows, k+1]
+    denom = left - 2*mid + right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shift = np.where(denom != 0, 0.5*(left-right)/denom, 0)
+    # The vertex of a parabola through three points can lie anywhere, but the maximum is within half a cycle of k
+    shift = np.clip(shift, -0.5, 0.5)
+
+    amplified = sustained_crossing(Fc, threshold, start, n_above)[1]
+    return np.where(amplified, k + shift + 1, np.nan)
+
+def efficiency( Fc, n_cycles=4 ):
+    """
+    LinRegPCR-style per-well efficiency. A line is fitted to log10(F) over the
+    exponential phase, i.e. the points from n_cycles below the second derivative
+    maximum up to it. Every well is fitted at once with masked sums.
+    :param int n_cycles: Width of the window of linearity, in cycles (log2 units of F).
+    :return: Amplification factor per cycle (2 = 100% efficient) and R^2 of the fit
+    :rtype: tuple(ndarray, ndarray)
+    """
+    k     = second_derivative_max(Fc)
+    rows  = np.arange(len(Fc))
+    upper = Fc[rows, k]
+    lower = upper*2.0**-n_cycles
+
+    cycles = np.arange(Fc.shape[1])
+    mask   = (cycles[None,:] <= k[:,None]) & (Fc > lower[:,None]) & (Fc <= upper[:,None])
+    logF   = np.log10(np.where(Fc > 0, Fc, 1))
+    slope, _, r2, n = masked_linear_fit(cycles[None,:], logF, mask)
+
+    ok = (n >= 3) & (upper > 0)
+    return np.where(ok, 10**slope, np.nan), np.where(ok, r2, np.nan)
+
+def call_cq( F, method='threshold', threshold=None, baseline=(2, 12), n_cycles=4, n_above=3 ):
+    """
+    Baseline correct the curves then call Cq and efficiency for every well.
+    :param ndarray F: Raw fluorescence (wells x cycles).
+    :param string method: 'threshold' or 'sdm' (second derivative maximum).
+    :param float threshold: Fluorescence threshold. Defaults to 10 SD of the baseline noise.
+    :param tuple baseline: Start and stop cycle indices of the baseline window.
+    :param int n_above: Cycles a curve has to stay above the threshold to be called.
+    :return: Cq, Efficiency and R2 per well, in the order of the rows of F
+    :rtype: DataFrame
+    """
+    start, stop = baseline
+    Fc = baseline_correct(np.asarray(F, dtype=float), start, stop)
+    if threshold is None: threshold = default_threshold(Fc, start, stop)
+
+    if method == 'threshold':
+        cq = threshold_cq(Fc, threshold, start, n_above)
+    elif method == 'sdm':
+        cq = sdm_cq(Fc, threshold, start, n_above)
+    else:
+        raise ValueError("method must be 'threshold' or 'sdm', got '{}'".format(method))
+
+    eff, r2 = efficiency(Fc, n_cycles)
+    eff     = np.where(np.isnan(cq), np.nan, eff)
+    return pd.DataFrame({'Cq': cq, 'Efficiency': eff, 'R2': r2})
+
+def replace_cq( df, positions, calls ):
+    """
+    Swap the instrument's Cq for the ones called from the raw curves, matched on well
+    Position, so the export can go through Data.tidy as usual. Wells that never
+    amplified get no Cq and so end up as 0 like any other undetermined well. Wells
+    missing from the curve file keep the instrument's Cq.
+    :param DataFrame df: Raw instrument export with a Position column.
+    :param ndarray positions: Well positions of the rows of calls.
+    :param DataFrame calls: Output of call_cq.
+    :rtype: DataFrame
+    """
+    calls = calls.set_index(pd.Index(positions, name='Position'))
+    df    = df.copy()
+    pos   = df['Position'].astype(str).str.strip()
+    in_curves        = pos.isin(calls.index).to_numpy()
+    df['Cq']         = np.where(in_curves, pos.map(calls['Cq']).to_numpy(), df['Cq'].to_numpy())
+    df['Efficiency'] = pos.map(calls['Efficiency']).to_numpy()
+    return df
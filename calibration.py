@@ -0,0 +1,142 @@
+import warnings
+import pandas as pd, numpy as np
+
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import lsqr
+
+#--------------------------------------------------------------------------------
+# Inter-plate calibration
+#
+# Every calibrator well is modelled as
+#
+#     Cq = mu[sample, target] + offset[plate]
+#
+# and all plates are solved for at once as a single sparse least-squares problem.
+# Calibrators are either named samples run on every plate or the wells of the
+# control group (cntl_grp). Offsets are relative to a reference plate, which is
+# fixed at 0. Offsets are only determined within a connected set of plates, those
+# linked by shared calibrators, directly or through other plates. A set that isn't
+# linked to the reference plate gets its own reference (its first plate, fixed at
+# 0) and a warning, since its offsets can't be compared with the other plates'.
+
+def select_calibrators( df, calibrators=None, cntl_grp=None ):
+    """
+    Pick out the wells used to estimate plate offsets from a tidied dataframe.
+    :param DataFrame df: Tidied well data (output of Data.tidy), with a Plate column.
+    :param list calibrators: Sample names run on more than one plate.
+    :param string cntl_grp: Treatment of the control group, used if no calibrators are given.
+    :return: Calibrator wells with a detected Cq
+    :rtype: DataFrame
+    """
+    if calibrators is not None:
+        mask = df['Sample'].isin(calibrators)
+    elif cntl_grp is not None:
+        mask = df['Treatment'] == cntl_grp
+    else:
+        raise ValueError('Either calibrators or cntl_grp must be given to calibrate plates.')
+
+    # Cq of 0 means undetermined (see Data.tidy), so it can't inform an offset
+    return df.loc[mask & (df['Cq'] > 0)]
+
+def plate_offsets( df, calibrators=None, cntl_grp=None, by=None, ref_plate=None ):
+    """
+    Estimate per-plate Cq offsets from calibrator wells shared across plates.
+    :param DataFrame df: Tidied well data for every plate of the study.
+    :param list calibrators: Sample names of inter-plate calibrators.
+    :param string cntl_grp: Treatment of the control group, used if no calibrators are given.
+    :param list by: Extra columns (e.g. ['Target']) to fit a separate offset per plate for.
+    :param ref_plate: Plate whose offset is fixed at 0. Defaults to the first plate.
+    :return: Offsets indexed by by + ['Plate']
+    :rtype: Series
+    """
+    by  = list(by) if by is not None else []
+    cal = select_calibrators(df, calibrators, cntl_grp)
+    if ref_plate is None: ref_plate = df['Plate'].min()
+
+    # One mean parameter per calibrator sample/target and one offset per plate (per `by` group).
+    # Sample names are reused across treatments, so treatment is part of a sample's identity.
+    mu_cols     = [c for c in ['Sample', 'Target', 'Treatment'] if c in cal.columns]
+    mu_codes, _ = pd.factorize(pd.MultiIndex.from_frame(cal[mu_cols]))
+    off_keys    = pd.MultiIndex.from_frame(cal[by + ['Plate']])
+    off_codes, off_index = pd.factorize(off_keys)
+    off_index   = off_index.set_names(by + ['Plate'])
+
+    # Reference plate offsets are fixed at 0 so they get no column. A `by` group that
+    # wasn't run on the reference plate is referenced to its own first plate instead.
+    off_frame   = off_index.to_frame(index=False)
+    on_ref      = off_frame['Plate'] == ref_plate
+    if by:
+        has_ref = on_ref.groupby([off_frame[b] for b in by]).transform('any')
+        first   = off_frame.groupby(by)['Plate'].transform('min')
+        is_ref  = np.where(has_ref, on_ref, off_frame['Plate'] == first)
+    else:
+        is_ref  = on_ref.to_numpy() if on_ref.any() else (off_frame['Plate'] == off_frame['Plate'].min()).to_numpy()
+
+    n_obs = len(cal)
+    n_mu  = mu_codes.max()+1 if n_obs else 0
+    rows  = np.arange(n_obs)
+
+    # Pin the first plate of every set of plates that no reference is linked to
+    is_ref      = pin_unlinked_plates(is_ref, off_frame, mu_codes, off_codes, n_mu)
+    free        = np.flatnonzero(~is_ref)
+    col_of_off  = np.full(len(off_index), -1)
+    col_of_off[free] = np.arange(len(free))
+    off_cols = col_of_off[off_codes]
+    has_off  = off_cols >= 0
+
+    A = csr_matrix((np.ones(n_obs + has_off.sum()),
+                    (np.concatenate([rows, rows[has_off]]),
+                     np.concatenate([mu_codes, n_mu + off_cols[has_off]]))),
+                   shape=(n_obs, n_mu + len(free)))
+    b = cal['Cq'].to_numpy(dtype=float)
+
+    solution = lsqr(A, b, atol=1e-10, btol=1e-10)[0] if n_obs else np.zeros(0)
+
+    offsets = np.zeros(len(off_index))
+    offsets[free] = solution[n_mu:]
+    offsets = pd.Series(offsets, index=off_index, name='Offset')
+    return offsets.sort_index()
+
+def pin_unlinked_plates( is_ref, off_frame, mu_codes, off_codes, n_mu ):
+    # Calibrators and plate offsets are the nodes of a graph with an edge for every
+    # calibrator well. Each connected component needs one offset fixed at 0, or the
+    # least-squares solution splits its Cq between mu and the offsets arbitrarily.
+    n_off = len(off_frame)
+    graph = csr_matrix((np.ones(len(mu_codes)), (mu_codes, n_mu + off_codes)), shape=(n_mu + n_off, n_mu + n_off))
+    _, component = connected_components(graph, directed=False)
+    component    = component[n_mu:]
+
+    is_ref   = np.asarray(is_ref, dtype=bool).copy()
+    unlinked = ~pd.Series(is_ref).groupby(component).transform('any').to_numpy()
+    if unlinked.any():
+        first = off_frame.assign(Component=component)[unlinked].sort_values('Plate').drop_duplicates('Component')
+        is_ref[first.index] = True
+        warnings.warn('Plates {} share no calibrators with the reference plate, so their offsets are '
+                      'relative to the first plate they are linked to.'.format(sorted(off_frame.loc[unlinked, 'Plate'].unique())))
+    return is_ref
+
+def apply_plate_offsets( df, offsets ):
+    """
+    Subtract plate offsets from Cq. Undetermined wells (Cq of 0) are left as they are.
+    :param DataFrame df: Tidied well data.
+    :param Series offsets: Output of plate_offsets.
+    :return: Copy of df with corrected Cq
+    :rtype: DataFrame
+    """
+    # Plates without any calibrator wells can't be corrected and keep an offset of 0
+    keys   = list(offsets.index.names)
+    shift  = df[keys].merge(offsets.reset_index(), how='left', on=keys)['Offset'].fillna(0).to_numpy()
+    df     = df.copy()
+    detected = df['Cq'] > 0
+    df['Cq'] = np.where(detected, df['Cq'] - shift, df['Cq'])
+    return df
+
+def calibrate( df, calibrators=None, cntl_grp=None, by=None, ref_plate=None ):
+    """
+    Estimate plate offsets and apply them in one go.
+    :return: Calibrated df and the offsets used
+    :rtype: tuple(DataFrame, Series)
+    """
+    offsets = plate_offsets(df, calibrators, cntl_grp, by, ref_plate)
+    return apply_plate_offsets(df, offsets), offsets
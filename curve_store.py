@@ -0,0 +1,172 @@
+import os
+import pandas as pd, numpy as np
+
+#--------------------------------------------------------------------------------
+# Append-only archive of raw amplification and melt curves
+#
+# Curves live in one flat float32 file which is memory-mapped for reading, so a
+# plate or a well comes back as a view into the file and nothing else is loaded.
+# Each stored plate is written as its axis (cycles or temperatures) followed by
+# a contiguous (wells x points) block. index.csv has one row per well giving
+# where its curve starts, keyed by Experiment, Plate, Well and Kind. It is read
+# once; rows appended afterwards are kept in memory as well as written out, and
+# merged into the cached index the next time it is used, so archiving many plates
+# doesn't re-read the index after every one.
+
+class CurveStore:
+    dtype         = np.dtype('<f4')
+    key_columns   = ['Experiment', 'Plate', 'Well', 'Kind']
+    index_columns = key_columns + ['Offset', 'Length', 'Axis']
+
+    def __init__( self, path ):
+        self.path        = path
+        self.data_fname  = os.path.join(path, 'curves.f32')
+        self.index_fname = os.path.join(path, 'index.csv')
+        self._index      = None
+        self._appended   = [] # rows written since the index was read
+        self._plates     = None
+        self._data       = None
+        os.makedirs(path, exist_ok=True)
+
+    @property
+    def index(self):
+        # Index of every stored well, read once, with the rows appended since merged in
+        if self._index is None:
+            if os.path.exists(self.index_fname):
+                index = pd.read_csv(self.index_fname, dtype={c: str for c in self.key_columns})
+            else:
+                index = pd.DataFrame({c: pd.Series(dtype=str) for c in self.key_columns})
+                for c in ['Offset', 'Length', 'Axis']: index[c] = pd.Series(dtype='int64')
+            index['Row']   = np.arange(len(index))
+            self._index    = index.set_index(self.key_columns).sort_index()
+            self._appended = []
+        if self._appended:
+            self._index    = pd.concat([self._index] + self._appended).sort_index()
+            self._appended = []
+        return self._index
+
+    @property
+    def plates(self):
+        # (experiment, plate, kind) of every stored plate
+        if self._plates is None:
+            keys         = self.index.index
+            self._plates = set(zip(keys.get_level_values('Experiment'), keys.get_level_values('Plate'), keys.get_level_values('Kind')))
+        return self._plates
+
+    @property
+    def data(self):
+        # Read-only memory map over the whole archive
+        if self._data is None:
+            if not os.path.exists(self.data_fname) or os.path.getsize(self.data_fname) == 0:
+                return np.zeros(0, dtype=self.dtype)
+            self._data = np.memmap(self.data_fname, dtype=self.dtype, mode='r')
+        return self._data
+
+    def __contains__( self, key ):
+        # key is (experiment, plate, kind)
+        experiment, plate, kind = key
+        return (str(experiment), str(plate), kind) in self.plates
+
+    def append( self, experiment, plate, wells, values, axis, kind='amplification' ):
+        """
+        Add every curve of one plate to the end of the archive.
+        :param string experiment: Experiment (run folder) the plate belongs to.
+        :param string plate: Plate name, e.g. the export file name.
+        :param array wells: Well position of each row of values.
+        :param ndarray values: Curves (wells x points).
+        :param ndarray axis: Cycle or temperature of each column of values.
+        :param string kind: 'amplification' or 'melt'.
+        """
+        experiment, plate = str(experiment), str(plate)
+        if (experiment, plate, kind) in self:
+            raise ValueError('{} curves for {}/{} are already stored'.format(kind, experiment, plate))
+
+        values = np.ascontiguousarray(values, dtype=self.dtype)
+        axis   = np.ascontiguousarray(axis, dtype=self.dtype)
+        n_wells, length = values.shape
+
+        # Data goes in before the index so an interrupted append leaves only unreferenced bytes
+        with open(self.data_fname, 'ab') as f:
+            start = f.tell()//self.dtype.itemsize
+            f.write(axis.tobytes())
+            f.write(values.tobytes())
+
+        rows = pd.DataFrame({
+                            'Experiment': experiment,
+                            'Plate'     : plate,
+                            'Well'      : np.asarray(wells).astype(str),
+                            'Kind'      : kind,
+                            'Offset'    : start + length + length*np.arange(n_wells),
+                            'Length'    : length,
+                            'Axis'      : start,
+                            })[self.index_columns]
+        n_stored = len(self._index) + sum(len(r) for r in self._appended)
+        rows.to_csv(self.index_fname, mode='a', index=False, header=not os.path.exists(self.index_fname))
+
+        rows['Row'] = n_stored + np.arange(n_wells)
+        self._appended.append(rows.set_index(self.key_columns))
+        self._plates.add((experiment, plate, kind))
+        self._data  = None
+
+    def _plate_rows( self, experiment, plate, kind ):
+        index = self.index
+        try:
+            rows = index.loc[(str(experiment), str(plate))]
+        except KeyError:
+            return index.iloc[0:0]
+        return rows[rows.index.get_level_values('Kind') == kind].sort_values('Offset')
+
+    def plate( self, experiment, plate, kind='amplification' ):
+        """
+        All curves of one plate as a view into the archive, in the order they were stored.
+        :return: Well positions, axis and curves (wells x points)
+        :rtype: tuple(ndarray, ndarray, ndarray)
+        """
+        rows = self._plate_rows(experiment, plate, kind)
+        if len(rows) == 0:
+            raise KeyError('No {} curves stored for {}/{}'.format(kind, experiment, plate))
+
+        first, length, axis = rows['Offset'].iloc[0], rows['Length'].iloc[0], rows['Axis'].iloc[0]
+        data   = self.data
+        values = data[first:first + length*len(rows)].reshape(len(rows), length)
+        wells  = rows.index.get_level_values('Well').to_numpy()
+        return wells, data[axis:axis+length], values
+
+    def well( self, experiment, plate, well, kind='amplification' ):
+        """
+        One curve as a view into the archive.
+        :return: Axis and curve
+        :rtype: tuple(ndarray, ndarray)
+        """
+        offset, length, axis = self.index.loc[(str(experiment), str(plate), str(well), kind), ['Offset', 'Length', 'Axis']]
+        data = self.data
+        return data[axis:axis+length], data[offset:offset+length]
+
+    def rows( self, row_ids ):
+        """
+        Curves for a set of index rows (see the Curve column added by Data.link_curves).
+        Unlike plate and well this has to gather, so it returns a copy. Rows of -1
+        (no stored curve) come back as NaN. All requested curves must be the same length.
+        :rtype: ndarray
+        """
+        row_ids = np.asarray(row_ids)
+        found   = row_ids >= 0
+        index   = self.index.sort_values('Row')
+        offsets = index['Offset'].to_numpy()[row_ids[found]]
+        lengths = np.unique(index['Length'].to_numpy()[row_ids[found]])
+        if len(lengths) > 1: raise ValueError('Curves of different lengths can only be read a plate at a time.')
+        length  = lengths[0] if len(lengths) else 0
+
+        out = np.full((len(row_ids), length), np.nan, dtype=self.dtype)
+        if found.any():
+            out[found] = self.data[offsets[:,None] + np.arange(length)[None,:]]
+        return out
+
+    def lookup( self, experiment, plate, wells, kind='amplification' ):
+        """
+        Index row of each well's curve, or -1 if it isn't stored.
+        :rtype: ndarray
+        """
+        keys = pd.DataFrame({'Experiment': experiment, 'Plate': plate, 'Well': np.asarray(wells), 'Kind': kind}).astype(str)
+        keys = pd.MultiIndex.from_frame(keys[self.key_columns])
+        return self.index['Row'].reindex(keys).fillna(-1).astype(int).to_numpy()
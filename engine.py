@@ -0,0 +1,222 @@
+import pandas as pd, numpy as np
+
+from numpy import power, log, sqrt
+
+#--------------------------------------------------------------------------------
+# Vectorized ddCq engine with error propagation
+#
+# Gives the same numbers as Data.calculate_RQ and Data.normalise_to_bio_ref, but
+# each stage is a single groupby/merge pass instead of a loop over rows. Every
+# mean also carries its variance and count, and these are propagated analytically
+# (on the log2 / Cq scale) through the chain:
+#
+#   Mean Cq      m_s = mean of tech reps           SE^2_s = var_s/n_s
+#   control      c   = mean of k control m_s       Var(c) = sum(SE^2)/k^2
+#   ddCq         d_s = c - m_s                     Var(d) = Var(c) + SE^2_s (- 2 SE^2_s/k if s is a control)
+#   RQ           2^d_s
+#   norm_RQ      2^(d_s - d_ref)
+#
+# From ddCq on, every value is a weighted sum of independent Mean Cq (see
+# log2_terms), so a shared control average is counted once and terms that
+# cancel (c when s and its bio ref share a control group, a control sample's own
+# m_s in the mean of its group) are gone before the variance is taken. The SE of
+# a group's mean norm_RQ adds up each Mean Cq's weight over the group's rows first.
+#
+# Linear-scale SEs follow from the delta method, SE(2^x) = 2^x ln2 SE(x).
+#
+# With per-target amplification factors A (e.g. from standard curves, see
+# standard_curve.py) instead of 100% efficiency, RQ = A^d_s and every log2 SE of
+# a target is scaled by log2(A).
+
+LN2 = log(2)
+
+def mean_cq(df):
+    """
+    Mean, variance and count of the tech reps of every sample, in one groupby pass.
+    Same rows as Data.calculate_mean_cq, plus Cq Var and n.
+    :param DataFrame df: Tidied wells of every plate.
+    :rtype: DataFrame
+    """
+    keys = ['Condition', 'Sample', 'Bio Rep', 'Plate', 'Treatment', 'Target']
+    mean_cq_df = df.groupby(keys, sort=True)['Cq'].agg(['mean', 'var', 'count']).reset_index()
+    mean_cq_df = mean_cq_df.rename(columns={'Condition': 'Age', 'mean': 'Mean Cq', 'var': 'Cq Var', 'count': 'n'})
+    mean_cq_df['Plate'] = mean_cq_df['Plate'].astype(int)
+
+    columns = ['Sample', 'Bio Rep', 'Target', 'Age', 'Mean Cq', 'Treatment', 'Plate', 'Cq Var', 'n']
+    return mean_cq_df[columns].sort_values(['Plate', 'Age', 'Target', 'Treatment'], kind='mergesort')
+
+def control_cq( mean_cq_df, cntl_grp, pooled=False ):
+    """
+    Average Mean Cq of the control group per Plate, Age and Target, with the variance of
+    that average and the number of samples in it. If pooled, the controls of every plate
+    are averaged together (for calibrated plates) and repeated for each plate.
+    :rtype: DataFrame
+    """
+    keys     = ['Age', 'Target'] if pooled else ['Plate', 'Age', 'Target']
+    controls = mean_cq_df.loc[mean_cq_df['Treatment'] == cntl_grp]
+    controls = controls.assign(se2=controls['Cq Var']/controls['n'])
+
+    grouped = controls.groupby(keys).agg({'Mean Cq': ['mean', 'count'], 'se2': 'sum'})
+    grouped.columns = ['Control Cq', 'k', 'se2_sum']
+    grouped['Control Var'] = grouped['se2_sum']/grouped['k']**2
+    grouped = grouped.drop('se2_sum', axis=1)
+
+    if pooled:
+        plate_keys = mean_cq_df[['Plate', 'Age', 'Target']].drop_duplicates()
+        grouped    = plate_keys.join(grouped, on=['Age', 'Target']).set_index(['Plate', 'Age', 'Target'])
+    return grouped.sort_index()
+
+def calculate_RQ( df, cntl_grp, pooled=False, amplification=None ):
+    """
+    RQ of every sample relative to the control group of its Plate, Age and Target.
+    Same rows and RQ as Data.calculate_RQ, plus Cq Var, n, log2(RQ) SE and RQ SE.
+    :param DataFrame df: Tidied wells of every plate.
+    :param string cntl_grp: Treatment of the control group.
+    :param bool pooled: Average controls across plates (for calibrated plates).
+    :param Series amplification: Amplification factor per Target (2 = 100% efficient).
+        Targets not in it, or all targets if it is None, are taken as 100% efficient.
+    :rtype: DataFrame
+    """
+    return relative_quantity(mean_cq(df), cntl_grp, pooled, amplification)
+
+def relative_quantity( mean_cq_df, cntl_grp, pooled=False, amplification=None ):
+    """
+    The ddCq step of calculate_RQ, starting from the output of mean_cq.
+    :rtype: DataFrame
+    """
+    controls   = control_cq(mean_cq_df, cntl_grp, pooled)
+    joined     = mean_cq_df.join(controls, on=['Plate', 'Age', 'Target'])
+
+    se2    = joined['Cq Var']/joined['n']
+    member = (joined['Treatment'] == cntl_grp).to_numpy()
+    # A control sample is part of its own control average, so its own error partly cancels
+    var    = joined['Control Var'] + se2 - np.where(member, 2*se2/joined['k'], 0)
+    ddcq   = joined['Control Cq'] - joined['Mean Cq']
+    base   = 2.0 if amplification is None else joined['Target'].map(amplification).fillna(2.0).to_numpy()
+
+    results_df = mean_cq_df.copy()
+    results_df['RQ']          = power(base, ddcq)
+    results_df['log2(RQ) SE'] = sqrt(var)*log(base)/LN2
+    results_df['RQ SE']       = results_df['RQ']*LN2*results_df['log2(RQ) SE']
+    if amplification is not None: results_df['Amplification'] = base
+    return results_df
+
+def normalise_to_bio_ref( rq_df, ref_gene, bio_ref, cntl_grp=None, pooled=False, select=None ):
+    """
+    Divide every RQ by the RQ of the bio ref (Age and Target given by bio_ref) with the
+    same Treatment and Bio Rep, then average over bio reps. Same as
+    Data.normalise_to_bio_ref, with propagated errors added.
+    :param DataFrame rq_df: Output of calculate_RQ.
+    :param string cntl_grp: Treatment of the control group RQ was computed against.
+    :param bool pooled: Whether the control averages were pooled across plates.
+    :param select: Function picking the rows of the normalised frame to average, if not all.
+    :return: Per-sample normalised RQ, and per Target/Age/Treatment means with the
+        propagated SE (norm_RQ SE) and the SEM between bio reps (norm_RQ SEM)
+    :rtype: tuple(DataFrame, DataFrame)
+    """
+    nf_age, nf_target = bio_ref[0], bio_ref[1]
+    rq_df = rq_df.loc[rq_df['Target'] != ref_gene].reset_index(drop=True)
+    rq_df['row'] = np.arange(len(rq_df))
+
+    # First bio ref sample per Treatment and Bio Rep, taking plates in order
+    nf = rq_df.loc[(rq_df['Age'] == nf_age) & (rq_df['Target'] == nf_target)]
+    nf = nf.sort_values('Plate', kind='mergesort').drop_duplicates(['Treatment', 'Bio Rep'])
+    nf = nf[['Treatment', 'Bio Rep', 'RQ', 'row']].rename(columns={'RQ': 'nf RQ', 'row': 'nf row'})
+
+    joined  = rq_df.merge(nf, on=['Treatment', 'Bio Rep'], how='left')
+    norm_RQ = joined['RQ']/joined['nf RQ']
+
+    terms = log2_terms(joined, cntl_grp, pooled)
+    var   = summed_var(terms['w']**2*terms['se2'], terms['row']).reindex(joined['row'])
+    var   = var.where(norm_RQ.notna().to_numpy())
+
+    norm_df = pd.DataFrame({
+                            'Target'          : joined['Target'].to_numpy(),
+                            'Sample'          : joined['Sample'].to_numpy(),
+                            'Bio Rep'         : joined['Bio Rep'].to_numpy(),
+                            'Age'             : joined['Age'].to_numpy(),
+                            'Treatment'       : joined['Treatment'].to_numpy(),
+                            'Plate'           : joined['Plate'].to_numpy(),
+                            'norm_RQ'         : norm_RQ.to_numpy(),
+                            'log(norm_RQ)'    : (log(norm_RQ)/LN2).to_numpy(),
+                            'log(norm_RQ) SE' : sqrt(var.to_numpy()),
+                            })
+    norm_df['norm_RQ SE'] = norm_df['norm_RQ']*LN2*norm_df['log(norm_RQ) SE']
+
+    if select is not None: norm_df = select(norm_df)
+    return norm_df, mean_norm_RQ(norm_df, terms)
+
+def log2_terms( joined, cntl_grp=None, pooled=False ):
+    """
+    log2(norm_RQ) of every row as a weighted sum of the Mean Cq of the samples it comes
+    from: x = b*(c - m) - b_ref*(c_ref - m_ref), with c and c_ref control averages and b
+    the log2 of the amplification factor. Mean Cq are independent, so (co)variances of
+    rows, and of their means, follow from the weights alone, with shared control
+    averages counted once and cancelling terms gone.
+    :param DataFrame joined: RQ rows numbered by row, with the row of their bio ref (nf row).
+    :return: row, source row, weight w and squared SE of the source's Mean Cq (se2)
+    :rtype: DataFrame
+    """
+    rows      = joined[['row', 'Plate', 'Age', 'Target', 'Treatment']].copy()
+    base      = joined['Amplification'] if 'Amplification' in joined.columns else 2.0
+    rows['b'] = log(base)/LN2
+    key       = ['Age', 'Target'] if pooled else ['Plate', 'Age', 'Target']
+
+    # As in control_cq, samples without a Mean Cq are not in the control average
+    member   = (rows['Treatment'] == cntl_grp) & joined['Mean Cq'].notna()
+    controls = rows.loc[member, key + ['row']].rename(columns={'row': 'source'})
+    rows     = rows.join(controls.groupby(key).size().rename('k'), on=key)
+
+    def ddcq_terms( of, sign ):
+        # Terms of sign*b*(c - m) of sample of['of'], for row of['row']
+        of      = of.merge(rows[['row', 'b', 'k'] + key].rename(columns={'row': 'of'}), on='of')
+        control = of.merge(controls, on=key).assign(w=lambda t: sign*t['b']/t['k'])
+        own     = of.assign(source=of['of'], w=-sign*of['b'])
+        return pd.concat([control, own], ignore_index=True)[['row', 'source', 'w']]
+
+    has_nf = joined['nf row'].notna()
+    terms  = pd.concat([ddcq_terms(pd.DataFrame({'row': joined['row'], 'of': joined['row']}), 1),
+                        ddcq_terms(pd.DataFrame({'row': joined.loc[has_nf, 'row'],
+                                                 'of' : joined.loc[has_nf, 'nf row'].astype(int)}), -1)], ignore_index=True)
+    terms  = terms.groupby(['row', 'source'], as_index=False)['w'].sum()
+
+    # A control without a variance adds none to its control average (as in control_cq),
+    # but leaves its own ddCq, and so anything it is the own sample of, without an SE
+    se2    = (joined['Cq Var']/joined['n']).where(~member | joined['Cq Var'].notna(), 0).to_numpy()
+    return terms.assign(se2=se2[terms['source'].to_numpy()])
+
+def summed_var( var, by ):
+    # Sum of variance terms, NaN (rather than skipped, as groupby sums do) if any is NaN
+    total = var.fillna(np.inf).groupby(by).sum()
+    return total.where(np.isfinite(total))
+
+def mean_norm_RQ( norm_df, terms ):
+    """
+    Mean norm_RQ per Target, Age and Treatment with the propagated SE of the mean, and
+    the SEM between bio reps from the count, sum and sum of squares. The SE is the delta
+    method on the weights of log2_terms: with R the norm_RQ of the n rows of a group,
+    Var(mean) = (ln2/n)^2 * sum over sources s of se2_s*(sum over rows i of R_i*w_is)^2,
+    so errors shared by the rows (their control averages) add up before squaring.
+    :param DataFrame terms: Output of log2_terms for the rows of norm_df (or more).
+    :rtype: DataFrame
+    """
+    keys  = ['Target', 'Age', 'Treatment']
+    valid = norm_df.loc[norm_df['norm_RQ'].notna()]
+    parts = valid.assign(sq=valid['norm_RQ']**2)
+    sums  = parts.groupby(keys).agg({'norm_RQ': ['sum', 'count'], 'sq': 'sum'})
+    sums.columns = ['sum', 'n', 'sq']
+
+    # norm_df rows are numbered as the rows of terms (see normalise_to_bio_ref)
+    rows     = valid[keys + ['norm_RQ']].assign(row=valid.index.to_numpy())
+    weighted = terms.merge(rows, on='row')
+    weighted = weighted.assign(Rw=weighted['norm_RQ']*weighted['w'])
+    by_group = weighted.groupby(keys + ['source']).agg({'Rw': 'sum', 'se2': 'first'})
+    var_sum  = summed_var(by_group['Rw']**2*by_group['se2'], by_group.index.droplevel('source'))
+
+    n = sums['n']
+    norm_df_mean = pd.DataFrame({'norm_RQ': sums['sum']/n}, index=sums.index)
+    norm_df_mean['norm_RQ SE']  = LN2*sqrt(var_sum.reindex(sums.index))/n
+    with np.errstate(divide='ignore', invalid='ignore'):
+        norm_df_mean['norm_RQ SEM'] = sqrt(np.maximum(sums['sq'] - sums['sum']**2/n, 0)/(n-1)/n)
+    norm_df_mean['n'] = n
+    return norm_df_mean.reset_index()
@@ -0,0 +1,211 @@
+import time, argparse
+import pandas as pd, numpy as np
+
+from qPCR import Data
+
+#--------------------------------------------------------------------------------
+# Differential testing of the analysis engines
+#
+# Runs the loop engine (the reference) and the faster engines on the same tidied
+# plates, either generated or recorded (e.g. test.csv), and checks that RQ,
+# norm_RQ and the group means agree within tolerance. The report lists mismatches
+# and the speedup of each engine over the loop.
+#
+#   python equivalence.py test.csv --generated 20
+#
+# Every dataset is also run with its samples renamed, since sample names need not
+# carry any meaning once a plate layout gives the bio reps.
+
+# Stage -> (function of a Data, columns identifying a row, columns compared)
+STAGES = {
+    'RQ'          : (lambda data: data.calculate_RQ(),             ['Plate', 'Sample', 'Treatment'], ['Mean Cq', 'RQ']),
+    'norm_RQ'     : (lambda data: data.normalise_to_bio_ref()[0],  ['Sample', 'Treatment'],          ['norm_RQ', 'log(norm_RQ)']),
+    'norm_RQ_mean': (lambda data: data.normalise_to_bio_ref()[1],  ['Target', 'Age', 'Treatment'],  ['norm_RQ']),
+}
+
+class FrameData(Data):
+    # Data that serves already tidied plates instead of reading exports
+    def __init__( self, plates, *args, **kwargs ):
+        super().__init__('', ['plate{}'.format(i+1) for i in range(len(plates))], *args, **kwargs)
+        self.plates = plates
+
+    def tidy_plate(self, i):
+        return self.plates[i].copy()
+
+def load_recorded(fname):
+    """
+    Tidied wells saved from Data.tidy_each_experiment (e.g. test.csv), split back into plates.
+    :rtype: list of DataFrame
+    """
+    df = pd.read_csv(fname, index_col=0, dtype={'Condition': str, 'Bio Rep': str})
+    return [plate.reset_index(drop=True) for _, plate in df.groupby('Plate')]
+
+def generate_plates( n_plates, ref_gene='BACTIN', bio_ref=('3', 'GRIN2AA'), ages=('3', '5', '7'), n_bio_reps=2,
+                     n_tech_reps=3, treatments=('Gravel', 'Non Gravel'), seed=None ):
+    """
+    Synthetic tidied plates laid out like ours: every plate has the reference gene and
+    one target (the bio ref target on plate 1), every age plus NEG, each treatment,
+    bio reps and tech reps. NEG wells are undetermined (Cq of 0).
+    :rtype: list of DataFrame
+    """
+    rng    = np.random.default_rng(seed)
+    plates = []
+    for p in range(n_plates):
+        target = bio_ref[1] if p == 0 else 'GENE{}'.format(p)
+        rows   = [(age, t, str(b), treatment)
+                  for t in [target, ref_gene] for age in list(ages) + ['NEG'] for treatment in treatments for b in range(1, n_bio_reps+1)]
+        layout = pd.DataFrame(rows, columns=['Condition', 'Target', 'Bio Rep', 'Treatment'])
+        layout['Sample']  = layout['Condition'] + '_' + layout['Target'] + '_' + layout['Bio Rep']
+        layout['Mean']    = rng.normal(25, 3, len(layout))
+
+        wells = layout.loc[layout.index.repeat(n_tech_reps)].reset_index(drop=True)
+        wells['Cq'] = np.where(wells['Condition'] == 'NEG', 0, wells['Mean'] + rng.normal(0, 0.4, len(wells)))
+        wells['Cq Mean']         = wells.groupby('Sample')['Cq'].transform('mean')
+        wells['Replicate Group'] = 'A' + (wells.index//n_tech_reps + 1).astype(str)
+        wells['Plate']           = p+1
+
+        columns = ['Sample', 'Bio Rep', 'Target', 'Cq', 'Cq Mean', 'Replicate Group', 'Condition', 'Treatment', 'Plate']
+        plates.append(wells[columns])
+    return plates
+
+def rename_samples( plates, seed=0 ):
+    """
+    The same plates with every sample given a meaningless name (X0, X1, ...) in random
+    order, as with a plate layout, so sample names no longer sort by bio rep.
+    :rtype: list of DataFrame
+    """
+    samples = pd.unique(pd.concat([plate['Sample'] for plate in plates]))
+    names   = dict(zip(samples, ['X{}'.format(i) for i in np.random.default_rng(seed).permutation(len(samples))]))
+    return [plate.assign(Sample=plate['Sample'].map(names)) for plate in plates]
+
+def positions(n):
+    # Well positions A1, A2, ... for n wells, 24 to a row
+    return ['{}{}'.format(chr(ord('A') + i//24), i%24 + 1) for i in range(n)]
+
+def write_exports( plates, path ):
+    """
+    Write tidied plates out as LightCycler exports, to be read back by Data (e.g. with a
+    layout or a query, which FrameData bypasses). Wells are at positions(len(plate)).
+    :param path: Directory (pathlib.Path) to write plate1.csv, plate2.csv, ... to.
+    :return: Plate names, for Data.fname_arr
+    :rtype: list of string
+    """
+    names = []
+    for i, plate in enumerate(plates):
+        export = pd.DataFrame({
+                                'Position'       : positions(len(plate)),
+                                'Sample Name'    : plate['Sample'].to_numpy(),
+                                'Gene Name'      : plate['Target'].to_numpy(),
+                                'Condition Name' : plate['Treatment'].to_numpy(),
+                                'Cq'             : plate['Cq'].to_numpy(),
+                                'Cq Mean'        : plate['Cq Mean'].to_numpy(),
+                                'Replicate Group': plate['Replicate Group'].to_numpy(),
+                                })
+        names.append('plate{}'.format(i+1))
+        export.to_csv(path / (names[-1] + '.csv'), index=False)
+    return names
+
+def align( df, keys ):
+    # Sort on the identifying columns, numbering repeats so duplicate keys still line up
+    df = df.reset_index(drop=True)
+    df = df.assign(_repeat=df.groupby(keys).cumcount())
+    for key in keys:
+        # The loop engine builds its frames from floats, so plate 1 may come back as 1.0
+        numeric = pd.api.types.is_numeric_dtype(df[key])
+        df[key] = df[key].astype(float).astype(str) if numeric else df[key].astype(str)
+    return df.sort_values(keys + ['_repeat']).reset_index(drop=True)
+
+def compare( expected, actual, keys, columns, rtol=1e-9, atol=1e-9 ):
+    """
+    Rows of two results that don't match: missing on either side, or a compared column
+    outside tolerance (NaN matches NaN).
+    :rtype: DataFrame
+    """
+    expected, actual = align(expected, keys), align(actual, keys)
+    merged = expected[keys + ['_repeat'] + columns].merge(actual[keys + ['_repeat'] + columns], on=keys + ['_repeat'],
+                                                       how='outer', suffixes=(' expected', ' actual'), indicator=True)
+
+    bad = merged['_merge'] != 'both'
+    for column in columns:
+        e = pd.to_numeric(merged[column + ' expected'], errors='coerce').to_numpy(dtype=float)
+        a = pd.to_numeric(merged[column + ' actual'], errors='coerce').to_numpy(dtype=float)
+        close = np.isclose(e, a, rtol=rtol, atol=atol, equal_nan=True)
+        bad  |= ~close
+    return merged.loc[bad].drop('_repeat', axis=1)
+
+def timed( stage, data ):
+    start  = time.perf_counter()
+    result = STAGES[stage][0](data)
+    return result, time.perf_counter() - start
+
+def run( plates, engines=('vectorized', 'streaming'), ref_gene='BACTIN', bio_ref=('3', 'GRIN2AA'), cntl_grp='Non Gravel',
+         rtol=1e-9, atol=1e-9, **kwargs ):
+    """
+    Run every engine against the loop engine on the same plates.
+    :param list plates: Tidied plates, e.g. from load_recorded or generate_plates.
+    :return: Summary per engine and stage (rows, mismatches, times, speedup), and the
+        mismatching rows
+    :rtype: tuple(DataFrame, DataFrame)
+    """
+    bio_ref   = list(bio_ref)
+    baseline  = FrameData(plates, ref_gene, bio_ref, cntl_grp, engine='loop', **kwargs)
+    summary, mismatches = [], []
+
+    for stage, (_, keys, columns) in STAGES.items():
+        try:
+            expected, loop_time = timed(stage, baseline)
+        except Exception as e:
+            summary.append({'Engine': 'loop', 'Stage': stage, 'Error': repr(e)})
+            continue
+
+        for name in engines:
+            data = FrameData(plates, ref_gene, bio_ref, cntl_grp, engine=name, **kwargs)
+            try:
+                actual, engine_time = timed(stage, data)
+            except Exception as e:
+                summary.append({'Engine': name, 'Stage': stage, 'Error': repr(e)})
+                continue
+
+            bad = compare(expected, actual, keys, columns, rtol, atol)
+            mismatches.append(bad.assign(Engine=name, Stage=stage))
+            summary.append({
+                            'Engine'    : name,
+                            'Stage'     : stage,
+                            'Rows'      : len(expected),
+                            'Mismatches': len(bad),
+                            'Loop s'    : loop_time,
+                            'Engine s'  : engine_time,
+                            'Speedup'   : loop_time/engine_time if engine_time > 0 else np.inf,
+                            'Error'     : None,
+                            })
+
+    mismatches = pd.concat(mismatches, sort=False, ignore_index=True) if mismatches else pd.DataFrame()
+    return pd.DataFrame(summary), mismatches
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that the fast engines reproduce the loop engine.')
+    parser.add_argument('recorded', nargs='*', help='Tidied well files such as test.csv')
+    parser.add_argument('--generated', type=int, default=0, help='Also check this many generated plates')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # Name, plates and the settings they are analysed with
+    datasets = [(fname, load_recorded(fname), {}) for fname in args.recorded]
+    if args.generated:
+        datasets.append(('generated', generate_plates(args.generated, seed=args.seed), {}))
+        # Nothing about our own experiment (BACTIN, GRIN2AA at age 3, Non Gravel) is built in
+        other = {'ref_gene': 'GAPDH', 'bio_ref': ('7', 'HDAC4'), 'cntl_grp': 'Vehicle'}
+        datasets.append(('generated (GAPDH, HDAC4 at 7, Vehicle)',
+                         generate_plates(args.generated, other['ref_gene'], other['bio_ref'],
+                                         treatments=('Vehicle', 'Drug'), seed=args.seed), other))
+    datasets += [(name + ' (renamed samples)', rename_samples(plates, args.seed), settings) for name, plates, settings in datasets]
+
+    failed = False
+    for name, plates, settings in datasets:
+        summary, mismatches = run(plates, **settings)
+        print(name)
+        print(summary.to_string(index=False))
+        if len(mismatches): print(mismatches.head(20).to_string(index=False))
+        failed |= bool(len(mismatches)) or summary['Error'].notna().any()
+
+    raise SystemExit(1 if failed else 0)
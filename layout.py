@@ -0,0 +1,78 @@
+import pandas as pd, numpy as np
+
+#--------------------------------------------------------------------------------
+# Plate layouts / sample sheets
+#
+# A layout is a table with one row per well, keyed by Plate and Position (or just
+# Position if every plate has the same layout), holding any metadata for that well:
+# Sample, Target, Condition (or Age), Bio Rep, Treatment, or anything else such as
+# Dose or Tissue. It is indexed once on its keys, and each plate is then joined to
+# it with a single hash lookup of all its wells. Values from the layout take the
+# place of those parsed from sample names in Data.add_columns.
+#
+#   Plate,Position,Sample,Condition,Bio Rep,Treatment,Dose
+#   1,A1,3_2AA_1,3,1,Gravel,10
+#   200228_plate2,A01,...
+
+# Layout columns that are labels, read as text whatever they look like
+LABELS = ['Plate', 'Position', 'Sample', 'Target', 'Condition', 'Bio Rep', 'Treatment']
+
+def normalise_positions(positions):
+    # 'a01', ' A1 ' and 'A1' are the same well
+    positions = pd.Series(positions).astype(str).str.strip().str.upper()
+    return positions.str.replace(r'^([A-Z]+)0*(\d+)$', r'\1\2', regex=True).to_numpy()
+
+def read_layout( layout, plate_names=None ):
+    """
+    Read a layout file (csv) or take a layout DataFrame, and index it on its keys.
+    Plates can be given by number (from 1, in the order of fname_arr) or by name.
+    :param layout: File name or DataFrame.
+    :param list plate_names: Plate file names (Data.fname_arr), to number plates given by name.
+    :return: Layout indexed on Plate and Position, or on Position alone
+    :rtype: DataFrame
+    """
+    if isinstance(layout, str):
+        layout = pd.read_csv(layout, dtype={column: str for column in LABELS}, skipinitialspace=True)
+    layout = layout.rename(columns=lambda x: x.strip()).rename(columns={'Age': 'Condition', 'Well': 'Position'})
+    if 'Position' not in layout.columns:
+        raise ValueError('A plate layout needs a Position column, got {}'.format(list(layout.columns)))
+
+    layout             = layout.copy()
+    layout['Position'] = normalise_positions(layout['Position'])
+    for column in LABELS[2:]:
+        if column in layout.columns: layout[column] = layout[column].where(layout[column].isna(), layout[column].astype(str).str.strip())
+
+    keys = ['Position']
+    if 'Plate' in layout.columns:
+        plate  = layout['Plate'].astype(str).str.strip()
+        number = pd.to_numeric(plate, errors='coerce')
+        if plate_names is not None:
+            number = number.fillna(plate.map({name: i+1 for i, name in enumerate(plate_names)}))
+        if number.isna().any():
+            raise ValueError('Unknown plates in layout: {}'.format(sorted(plate[number.isna()].unique())))
+        layout['Plate'] = number.astype(int)
+        keys            = ['Plate', 'Position']
+
+    return layout.set_index(keys, verify_integrity=True).sort_index()
+
+def join_layout( df, layout ):
+    """
+    Attach the layout to the wells of df in one lookup. Layout values replace the
+    export's where the layout has them, other layout columns are added.
+    :param DataFrame df: Wells with Position (and Plate) columns.
+    :param DataFrame layout: Output of read_layout.
+    :rtype: DataFrame
+    """
+    keys = list(layout.index.names)
+    key  = pd.Series(normalise_positions(df['Position']), index=df.index, name='Position')
+    if keys == ['Position']:
+        wells = pd.Index(key)
+    else:
+        wells = pd.MultiIndex.from_arrays([df['Plate'].astype(int).to_numpy(), key.to_numpy()], names=keys)
+
+    found = layout.reindex(wells)
+    df    = df.copy()
+    for column in found.columns:
+        values = found[column].to_numpy()
+        df[column] = values if column not in df.columns else np.where(pd.isna(values), df[column].to_numpy(), values)
+    return df
@@ -0,0 +1,156 @@
+import os, sys, json, time, hashlib, argparse
+import pandas as pd, numpy as np
+
+from results_db import ResultsDB
+
+#--------------------------------------------------------------------------------
+# Run manifests
+#
+# A manifest records everything the results of a Data run depend on:
+#
+#   inputs      - SHA-256, size and modification time of every file read
+#   parameters  - the Data arguments that change results (ref_gene, bio_ref, ...)
+#   code        - a hash of the analysis source and the numpy/pandas/Python versions
+#
+# and fingerprints of the inputs (all three of the above) and of the outputs. It is
+# stored with the results in a ResultsDB. A batch run compares each experiment's
+# current inputs fingerprint with the stored one and only analyses experiments that
+# changed; the others keep their stored results. Files whose size and modification
+# time match the stored manifest aren't hashed again, so checking an unchanged
+# experiment costs a stat per file.
+#
+#   python manifests.py experiments.json results.db
+
+# Modules whose code affects the results, or what is stored of them
+CODE = ['qPCR', 'engine', 'streaming', 'parsers', 'calibration', 'amplification', 'melt', 'standard_curve',
+        'layout', 'accumulator', 'curve_store', 'significance', 'scheduler', 'results_db']
+
+# Data attributes that affect the results
+PARAMETERS = ['fname_arr', 'ref_gene', 'bio_ref', 'cntl_grp', 'treated', 'calibrate', 'calibrators', 'curve_fname_arr',
+              'cq_method', 'melt_fname_arr', 'fmt', 'engine', 'standards', 'efficiency', 'layout']
+
+def digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+def file_hash( fname, block_size=1<<20 ):
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''): h.update(block)
+    return h.hexdigest()
+
+def frame_fingerprint(df):
+    # Same columns and values give the same fingerprint, whatever the index
+    if df is None: return None
+    values = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    return digest(json.dumps(list(map(str, df.columns))).encode() + values.tobytes())
+
+def jsonable(value):
+    if isinstance(value, pd.DataFrame): return {'frame': frame_fingerprint(value)}
+    if isinstance(value, pd.Series):    return jsonable(value.to_dict())
+    if isinstance(value, dict):         return {str(k): jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)): return [jsonable(v) for v in value]
+    if isinstance(value, np.generic):   return value.item()
+    return value
+
+def input_files(data):
+    """
+    Every file a Data object reads.
+    :rtype: list
+    """
+    fnames = [data.data_path+fname+'.csv' for fname in data.fname_arr]
+    for extra in [data.curve_fname_arr, data.melt_fname_arr]:
+        if extra is not None: fnames += [data.data_path+fname+'.csv' for fname in extra]
+    if isinstance(data.layout, str): fnames.append(data.layout)
+    return fnames
+
+def hash_inputs( fnames, previous=None ):
+    """
+    SHA-256, size and modification time of each file. Hashes from a previous manifest are
+    reused for files whose size and modification time haven't changed. Missing files
+    (e.g. curves only kept in a curve store) are recorded as missing.
+    :rtype: dict
+    """
+    previous = previous or {}
+    inputs   = {}
+    for fname in fnames:
+        try:
+            stat = os.stat(fname)
+        except FileNotFoundError:
+            inputs[fname] = {'sha256': 'missing'}
+            continue
+
+        known = previous.get(fname, {})
+        same  = known.get('size') == stat.st_size and known.get('mtime_ns') == stat.st_mtime_ns
+        inputs[fname] = {'sha256': known['sha256'] if same else file_hash(fname), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    return inputs
+
+def code_version():
+    here   = os.path.dirname(os.path.abspath(__file__))
+    source = hashlib.sha256()
+    for module in CODE:
+        with open(os.path.join(here, module+'.py'), 'rb') as f: source.update(f.read())
+    return {'source': source.hexdigest(), 'python': sys.version.split()[0], 'numpy': np.__version__, 'pandas': pd.__version__}
+
+def build( data, previous=None ):
+    """
+    Manifest of the inputs of a Data run, before anything is analysed.
+    :param dict previous: The last manifest stored for this experiment, to reuse file hashes.
+    :rtype: dict
+    """
+    manifest = {
+                'inputs'    : hash_inputs(input_files(data), previous and previous.get('inputs')),
+                'parameters': {name: jsonable(getattr(data, name)) for name in PARAMETERS},
+                'code'      : code_version(),
+               }
+    hashes = {fname: entry['sha256'] for fname, entry in manifest['inputs'].items()}
+    manifest['Inputs Fingerprint'] = digest(json.dumps([hashes, manifest['parameters'], manifest['code']], sort_keys=True).encode())
+    return manifest
+
+def finish( manifest, **outputs ):
+    """
+    Add the fingerprint of every output frame, and of all of them together.
+    :rtype: dict
+    """
+    manifest = dict(manifest, outputs={name: frame_fingerprint(df) for name, df in outputs.items()})
+    manifest['Outputs Fingerprint'] = digest(json.dumps(manifest['outputs'], sort_keys=True).encode())
+    manifest['created']             = time.strftime('%Y-%m-%dT%H:%M:%S')
+    return manifest
+
+def run_batch( experiments, db, force=False ):
+    """
+    Analyse and store the experiments whose inputs, parameters or code changed since their
+    results were stored. The others are skipped and keep their stored results.
+    :param dict experiments: Experiment name -> Data.
+    :param db: A ResultsDB or the file name of one.
+    :param bool force: Analyse every experiment.
+    :return: Status ('analysed' or 'unchanged'), fingerprints and time taken per experiment
+    :rtype: DataFrame
+    """
+    if isinstance(db, str): db = ResultsDB(db)
+
+    rows = []
+    for name, data in experiments.items():
+        start    = time.perf_counter()
+        stored   = db.manifest(name)
+        current  = build(data, stored)
+        if not force and stored is not None and stored['Inputs Fingerprint'] == current['Inputs Fingerprint']:
+            status, manifest = 'unchanged', stored
+        else:
+            status, manifest = 'analysed', data.save_results(db, experiment=name, manifest=current).manifest(name)
+
+        rows.append({'Experiment': name, 'Status': status, 'Inputs Fingerprint': manifest['Inputs Fingerprint'],
+                     'Outputs Fingerprint': manifest['Outputs Fingerprint'], 'Seconds': time.perf_counter() - start})
+    return pd.DataFrame(rows)
+
+if __name__ == '__main__':
+    from qPCR import Data
+
+    parser = argparse.ArgumentParser(description='Re-analyse only the experiments that changed since their results were stored.')
+    parser.add_argument('config', help='JSON file of {"name": {...Data arguments}}, as for server.py')
+    parser.add_argument('db', help='Results database')
+    parser.add_argument('--force', action='store_true', help='Analyse every experiment')
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        experiments = {name: Data(**kwargs) for name, kwargs in json.load(f).items()}
+    print(run_batch(experiments, args.db, args.force).to_string(index=False))
@@ -0,0 +1,119 @@
+import pandas as pd, numpy as np
+
+from scipy.ndimage import uniform_filter1d
+
+#--------------------------------------------------------------------------------
+# Melt-curve specificity QC
+#
+# Works on a -dF/dT matrix D of shape (wells, temperatures) for a whole plate at
+# once. A well passes if it has at most one melt peak and, when wells are grouped
+# by target, that peak sits at the same Tm as the rest of the target's wells.
+# Wells without a product at all (e.g. NEG) have no peak and pass.
+
+def read_melt(fname):
+    """
+    Reads a -dF/dT export with one row per well: a Position column followed by one
+    column per temperature (the column headers).
+    :return: Well positions, temperatures and the -dF/dT matrix (wells x temperatures)
+    :rtype: tuple(ndarray, ndarray, ndarray)
+    """
+    df = pd.read_csv(fname, header=0)
+    df.rename(columns=lambda x: x.strip(), inplace=True)
+    positions = df['Position'].astype(str).str.strip().to_numpy()
+    df        = df.drop('Position', axis=1)
+    temps     = df.columns.astype(float).to_numpy()
+    return positions, temps, df.to_numpy(dtype=float)
+
+def smooth( D, window=5 ):
+    # Moving average along the temperature axis of every well
+    return uniform_filter1d(D, size=window, axis=1, mode='nearest')
+
+def find_peaks( D, temps, rel_height=0.1, min_height=None, window=5 ):
+    """
+    Smooth every curve and find its local maxima. Peaks lower than rel_height of the
+    well's own highest peak, or lower than min_height, are ignored.
+    :param ndarray D: -dF/dT (wells x temperatures).
+    :param ndarray temps: Temperature of each column of D.
+    :param float min_height: Absolute floor for a peak. Defaults to rel_height of the
+        median highest peak over all wells, which keeps noise in NEG wells from counting.
+    :return: Tm, number of peaks, height of the main peak and of the next highest one
+    :rtype: DataFrame
+    """
+    Ds  = smooth(np.asarray(D, dtype=float), window)
+    top = Ds.max(axis=1)
+    if min_height is None: min_height = rel_height*np.median(top)
+
+    mid     = Ds[:, 1:-1]
+    is_peak = (mid > Ds[:, :-2]) & (mid >= Ds[:, 2:])
+    is_peak = np.pad(is_peak, ((0,0),(1,1)), mode='constant')
+    is_peak &= (Ds >= rel_height*top[:,None]) & (Ds >= min_height)
+
+    n_peaks = is_peak.sum(axis=1)
+    heights = np.where(is_peak, Ds, -np.inf)
+    k       = np.argmax(heights, axis=1)
+    ranked  = np.sort(heights, axis=1)
+
+    # Refine the main peak with a parabola through its neighbours, then map onto temperature
+    rows = np.arange(len(Ds))
+    kk   = np.clip(k, 1, Ds.shape[1]-2)
+    left, centre, right = Ds[rows, kk-1], Ds[rows, kk], Ds[rows, kk+1]
+    denom = left - 2*centre + right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shift = np.where(denom != 0, 0.5*(left-right)/denom, 0)
+    tm = np.interp(kk + shift, np.arange(len(temps)), temps)
+
+    has_peak = n_peaks > 0
+    return pd.DataFrame({
+                        'Tm'                : np.where(has_peak, tm, np.nan),
+                        'Melt Peaks'        : n_peaks,
+                        'Peak Height'       : np.where(has_peak, ranked[:, -1], 0),
+                        'Second Peak Height': np.where(n_peaks > 1, ranked[:, -2], 0),
+                        })
+
+def flag_wells( peaks, groups=None, tm_tol=1.0 ):
+    """
+    Mark which wells pass specificity QC.
+    :param DataFrame peaks: Output of find_peaks.
+    :param array groups: Target of each well. If given, a well also fails when its Tm is
+        more than tm_tol away from the median Tm of its target.
+    :return: peaks with an added boolean Melt Pass column
+    :rtype: DataFrame
+    """
+    peaks = peaks.copy()
+    single = peaks['Melt Peaks'] <= 1
+
+    if groups is not None:
+        expected = peaks['Tm'].groupby(np.asarray(groups)).transform('median')
+        on_target = ~((peaks['Tm'] - expected).abs() > tm_tol)
+    else:
+        on_target = True
+
+    peaks['Melt Pass'] = single & on_target
+    return peaks
+
+def analyse( D, temps, groups=None, rel_height=0.1, min_height=None, tm_tol=1.0, window=5 ):
+    """
+    Peak detection and QC flags for every well of a plate.
+    :rtype: DataFrame
+    """
+    peaks = find_peaks(D, temps, rel_height, min_height, window)
+    return flag_wells(peaks, groups, tm_tol)
+
+def join_flags( df, positions, flags ):
+    """
+    Attach melt results to a raw instrument export, matched on well Position, so they
+    carry through Data.tidy.
+    :param DataFrame df: Raw instrument export with a Position column.
+    :param ndarray positions: Well positions of the rows of flags.
+    :param DataFrame flags: Output of analyse.
+    :rtype: DataFrame
+    """
+    flags = flags.set_index(pd.Index(positions, name='Position'))
+    df    = df.copy()
+    pos   = df['Position'].astype(str).str.strip()
+    for column in ['Tm', 'Melt Peaks', 'Melt Pass']:
+        df[column] = pos.map(flags[column]).to_numpy()
+
+    # Wells missing from the melt export can't be judged, so they are kept
+    df['Melt Pass'] = df['Melt Pass'].fillna(True).astype(bool)
+    return df
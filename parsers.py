@@ -0,0 +1,127 @@
+import pandas as pd, numpy as np
+
+from collections import OrderedDict
+
+#--------------------------------------------------------------------------------
+# Instrument export parsers
+#
+# Each parser declares how to recognise its instrument's export from the header line,
+# which of its columns map onto the canonical well columns below, and their dtypes.
+# Only those columns are read. Every parser emits the same frame, which Data.tidy
+# turns into the tidied schema used by calculate_mean_cq. New instruments are
+# added by subclassing Parser and decorating the class with @register.
+
+CANONICAL = ['Position', 'Sample', 'Target', 'Treatment', 'Cq', 'Cq Mean', 'Replicate Group']
+
+PARSERS = OrderedDict()
+
+def register(parser):
+    PARSERS[parser.name] = parser()
+    return parser
+
+class Parser:
+    name      = None
+    signature = ()   # columns that identify the format, all must be in the header line
+    columns   = {}   # export column -> canonical column
+    numeric   = ['Cq', 'Cq Mean']
+
+    def matches( self, header ):
+        return all(column in header for column in self.signature)
+
+    def read( self, fname, header_row=0, sep=',' ):
+        """
+        Read the mapped columns of an export whose header is on line header_row.
+        :rtype: DataFrame
+        """
+        # Non-numeric Cq such as 'Undetermined', 'N/A' or '-' becomes NaN here and 0 after Data.tidy
+        usecols = lambda column: column.strip() in self.columns
+        df = pd.read_csv(fname, sep=sep, skiprows=header_row, header=0, usecols=usecols, dtype=str,
+                         skip_blank_lines=False, skipinitialspace=True)
+        df.rename(columns=lambda x: self.columns[x.strip()], inplace=True)
+        df = df.loc[:, ~df.columns.duplicated()].dropna(how='all')
+
+        for column in CANONICAL:
+            if column not in df.columns: df[column] = np.nan
+        for column in self.numeric:
+            df[column] = pd.to_numeric(df[column], errors='coerce')
+
+        return df[CANONICAL].reset_index(drop=True)
+
+@register
+class LightCycler(Parser):
+    name      = 'lightcycler'
+    signature = ('Sample Name', 'Gene Name', 'Cq')
+    columns   = {
+                'Position'       : 'Position',
+                'Sample Name'    : 'Sample',
+                'Gene Name'      : 'Target',
+                'Condition Name' : 'Treatment',
+                'Cq'             : 'Cq',
+                'Cq Mean'        : 'Cq Mean',
+                'Replicate Group': 'Replicate Group',
+                }
+
+@register
+class QuantStudio(Parser):
+    # Results export, after the '*' prefixed block of run information
+    name      = 'quantstudio'
+    signature = ('Well Position', 'Sample Name', 'Target Name')
+    columns   = {
+                'Well Position'   : 'Position',
+                'Sample Name'     : 'Sample',
+                'Target Name'     : 'Target',
+                'Biological Group': 'Treatment',
+                'CT'              : 'Cq',
+                'Cq'              : 'Cq',
+                'Ct Mean'         : 'Cq Mean',
+                'Cq Mean'         : 'Cq Mean',
+                }
+
+@register
+class CFX(Parser):
+    # Bio-Rad CFX Maestro 'Quantification Cq Results' export
+    name      = 'cfx'
+    signature = ('Well', 'Fluor', 'Target', 'Sample', 'Cq')
+    columns   = {
+                'Well'               : 'Position',
+                'Sample'             : 'Sample',
+                'Target'             : 'Target',
+                'Biological Set Name': 'Treatment',
+                'Cq'                 : 'Cq',
+                'Cq Mean'            : 'Cq Mean',
+                }
+
+def header_fields(line):
+    # Split a header line on tabs if it has any, otherwise on commas
+    sep = '\t' if '\t' in line else ','
+    return [field.strip().strip('"') for field in line.rstrip('\r\n').split(sep)], sep
+
+def detect( fname, fmt=None, max_lines=100 ):
+    """
+    Find the export format from the first header line any parser recognises, or only
+    look for the header of fmt if it is given. Lines of run information above the
+    table are skipped.
+    :return: Parser, line number of the header and field separator
+    :rtype: tuple(Parser, int, string)
+    """
+    if fmt is not None and fmt not in PARSERS:
+        raise ValueError('Unknown format {}, known formats are {}'.format(fmt, list(PARSERS)))
+    candidates = [PARSERS[fmt]] if fmt is not None else list(PARSERS.values())
+
+    with open(fname, encoding='utf-8-sig', errors='replace') as f:
+        for row, line in enumerate(f):
+            if row >= max_lines: break
+            header, sep = header_fields(line)
+            for parser in candidates:
+                if parser.matches(header): return parser, row, sep
+
+    raise ValueError('Unrecognised export format in {}, looked for {}'.format(fname, [p.name for p in candidates]))
+
+def read_plate( fname, fmt=None ):
+    """
+    Read one plate export into the canonical well columns, detecting the format unless
+    fmt names one of PARSERS.
+    :rtype: DataFrame
+    """
+    parser, header_row, sep = detect(fname, fmt)
+    return parser.read(fname, header_row, sep)
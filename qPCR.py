@@ -1,32 +1,59 @@
-import pandas as pd, numpy as np, re
+import pandas as pd, numpy as np, re, os
 
 from numpy import asarray, power, log
 from scipy.stats.mstats import gmean
 
 import seaborn as sns
 
+import calibration, amplification, melt, significance, parsers, engine, streaming, standard_curve, layout, query, scheduler, sample_size, accumulator, manifests
+from curve_store import CurveStore
+from accumulator import PlateAccumulator
+from results_db import ResultsDB
+
 class Data:
-    def __init__( self, data_path, fname_arr, ref_gene, bio_ref, cntl_grp, treated=True ):
-        self.data_path = data_path
-        self.fname_arr = fname_arr
-        self.ref_gene  = ref_gene
-        self.bio_ref   = bio_ref
-        self.cntl_grp  = cntl_grp
-        self.treated   = treated
+    def __init__( self, data_path, fname_arr, ref_gene, bio_ref, cntl_grp, treated=True, calibrate=False, calibrators=None,
+                  curve_fname_arr=None, cq_method='threshold', melt_fname_arr=None, curve_store=None, fmt=None,
+                  engine='loop', plates_per_chunk=8, standards=None, efficiency=None,
+                  layout=None ):
+        self.data_path        = data_path
+        self.fname_arr        = fname_arr
+        self.ref_gene         = ref_gene
+        self.bio_ref          = bio_ref
+        self.cntl_grp         = cntl_grp
+        self.treated          = treated
+        self.calibrate        = calibrate
+        self.calibrators      = calibrators
+        self.curve_fname_arr  = curve_fname_arr # raw amplification curves, one file per plate in fname_arr
+        self.cq_method        = cq_method
+        self.melt_fname_arr   = melt_fname_arr # -dF/dT melt curves, one file per plate in fname_arr
+        self.curve_store      = CurveStore(curve_store) if isinstance(curve_store, str) else curve_store
+        self.fmt              = fmt # instrument export format, detected from the file if None. See parsers.py
+        self.engine           = engine # 'loop', 'vectorized' (engine.py, also propagates errors) or 'streaming' (streaming.py)
+        self.plates_per_chunk = plates_per_chunk # plates held in memory at once by the streaming engine
+        self.standards        = standards # sample name -> known quantity of the dilution series wells
+        self.efficiency       = efficiency # None (100%), 'standards' or target -> amplification factor (2 = 100%)
+        self.layout           = layout # plate layout / sample sheet file or DataFrame keyed by Plate and Position. See layout.py
+        self.layout_index     = None
+        self.pushdown         = None # rows to read, set on the copies made by query.Query
 
     log2 = lambda self,x: log(x)/log(2)
 
     def load_csv(self):
         # Reads multiple csv files. Input path of file and
         # array of filenames assuming they are in the same folder. Output a list of dataframes.
+        # Only the columns the analysis needs are read, whichever instrument the export came from.
         df_list = []
         for i, df_name in enumerate(self.fname_arr):
-            fname  = self.data_path+df_name+'.csv'
-            df = pd.read_csv(fname, header=0)
-            df['Plate'] = i+1
-            df_list.append(df)
+            df_list.append(self.load_plate(i))
         return df_list
 
+    def load_plate(self, i):
+        # Reads the export of plate i, numbering plates from 1
+        fname = self.data_path+self.fname_arr[i]+'.csv'
+        df = parsers.read_plate(fname, self.fmt)
+        df['Plate'] = i+1
+        return df
+
     def raw_data(self):
         return self.load_csv()
 
@@ -34,13 +61,37 @@ class Data:
     # Just a bunch of housekeeping functions to tidy and prepare raw LightCycler data
 
     def tidy_each_experiment(self):
-        df_list = self.load_csv()
         tidied  = []
-        for df in df_list:
-            t_df = self.tidy(df)
+        for i in self.plate_indices():
+            t_df = self.tidy_plate(i)
             tidied.append(t_df)
         return tidied
 
+    def plate_indices(self):
+        # Plates to read, which is all of them unless a query pushed down a plate filter
+        if self.pushdown is None: return list(range(len(self.fname_arr)))
+        return self.pushdown.plates(len(self.fname_arr))
+
+    def tidy_plate(self, i):
+        # Load and tidy a single plate, calling Cq and checking melt curves first if there are raw curves
+        df = self.load_plate(i)
+        # A layout may give the targets, in which case rows can only be filtered once it is joined
+        if self.pushdown is not None and self.layout is None: df = self.pushdown.early(df, i)
+        if self.curve_fname_arr is not None: df = self.call_cq_from_curves(df, i)
+        if self.melt_fname_arr  is not None: df = self.check_melt_curves(df, i)
+        df = self.tidy(df)
+        if self.pushdown is not None: df = self.pushdown.late(df, i)
+        return df
+
+    def query(self, **filters):
+        """
+        Lazy selection of target, age, treatment and/or plate, pushed down into reading
+        when a stage is computed, e.g. data.query(target='GRIN2AB').normalise_to_bio_ref().
+        See query.py.
+        :rtype: query.Query
+        """
+        return query.Query(self, **filters)
+
     def tidy(self,df):
 
         df = self.trim_all_columns(df)
@@ -53,6 +104,8 @@ class Data:
 
         df['Cq'] = pd.to_numeric(df['Cq'])
 
+        if self.layout is not None: df = self.join_layout(df)
+
         if self.treated: df['Treatment'] = df['Treatment'].str.title()
 
         df = self.add_columns(df)
@@ -62,9 +115,90 @@ class Data:
 
         # Reorder columns
         columns_titles = ['Sample','Bio Rep', 'Target', 'Cq', 'Cq Mean', 'Replicate Group', 'Condition', 'Treatment', 'Plate']
+        # Keep the well position and per-well results from raw curve and melt curve analysis if there are any
+        columns_titles += [c for c in ['Position', 'Efficiency', 'Tm', 'Melt Peaks', 'Melt Pass'] if c in df.columns]
+        # and any other metadata from the plate layout
+        columns_titles += [c for c in df.columns if c not in columns_titles and self.layout_index is not None and c in self.layout_index.columns]
         df = df[columns_titles]
         return df
 
+    def call_cq_from_curves(self, df, i):
+        """
+        Replace the exported Cq of plate i with Cq called from its raw amplification curves.
+        See amplification.py.
+        :rtype: DataFrame
+        """
+        positions, cycles, F = self.read_raw_curves(i, 'amplification')
+        calls                = amplification.call_cq(F, method=self.cq_method)
+        return amplification.replace_cq(df, positions, calls)
+
+    def check_melt_curves(self, df, i):
+        """
+        Find melt peaks for every well of plate i and flag non-specific ones. Wells are
+        compared against the other wells of the same target. See melt.py.
+        :rtype: DataFrame
+        """
+        positions, temps, D = self.read_raw_curves(i, 'melt')
+        targets             = pd.Series(df['Target'].astype(str).str.strip().to_numpy(),
+                                        index=df['Position'].astype(str).str.strip()).reindex(positions)
+        flags               = melt.analyse(D, temps, groups=targets.fillna('').to_numpy())
+        return melt.join_flags(df, positions, flags)
+
+    def join_layout(self, df):
+        """
+        Attach the plate layout to the wells of a plate, indexing the layout on first use.
+        Layout columns replace the ones parsed from sample names. See layout.py.
+        :rtype: DataFrame
+        """
+        if self.layout_index is None: self.layout_index = layout.read_layout(self.layout, self.fname_arr)
+        return layout.join_layout(df, self.layout_index)
+
+    @property
+    def experiment(self):
+        # Name used for this run in the curve store, i.e. the folder the exports are in
+        return os.path.basename(os.path.normpath(self.data_path))
+
+    def read_raw_curves(self, i, kind):
+        """
+        Raw amplification or melt curves of plate i. With a curve store they are read from
+        the store if already archived there, and archived on first read otherwise.
+        :return: Well positions, axis (cycles or temperatures) and curves (wells x points)
+        :rtype: tuple(ndarray, ndarray, ndarray)
+        """
+        plate = self.fname_arr[i]
+        store = self.curve_store
+        if store is not None and (self.experiment, plate, kind) in store:
+            return store.plate(self.experiment, plate, kind)
+
+        if kind == 'amplification':
+            positions, values = amplification.read_curves(self.data_path+self.curve_fname_arr[i]+'.csv')
+            axis              = np.arange(1, values.shape[1]+1)
+        else:
+            positions, axis, values = melt.read_melt(self.data_path+self.melt_fname_arr[i]+'.csv')
+
+        if store is None: return positions, axis, values
+
+        # Read back what was archived, so the first run sees the same (float32) values as every later one
+        store.append(self.experiment, plate, positions, values, axis, kind)
+        return store.plate(self.experiment, plate, kind)
+
+    def link_curves(self, df, kind='amplification'):
+        """
+        Add a Curve column holding the curve store row of each well's raw curve, or -1 if it
+        isn't archived. Works on any frame with Plate and Position columns, e.g. tidied wells.
+        Curves can then be read back with self.curve_store.rows(df['Curve']).
+        :rtype: DataFrame
+        """
+        plates    = asarray(self.fname_arr)[df['Plate'].astype(int).to_numpy()-1]
+        df        = df.copy()
+        df['Curve'] = self.curve_store.lookup(self.experiment, plates, df['Position'], kind)
+        return df
+
+    def exclude_failed_wells(self,df):
+        # Drop wells that failed melt curve QC, if melt curves were checked
+        if 'Melt Pass' not in df.columns: return df
+        return df.loc[df['Melt Pass'].astype(bool)].drop(['Tm', 'Melt Peaks', 'Melt Pass'], axis=1)
+
     def trim_all_columns(self,df):
         """
         Trim whitespace from ends of each value across all series in dataframe
@@ -78,8 +212,9 @@ class Data:
 
     def remove_columns(self,df):
         #Remove extraneous columns generated by LightCycler export. Columns that are retained are commented out.
+        #Exports read through parsers.py only have the retained columns to begin with.
         df = df.drop(['Color',
-         'Position',
+        #  'Position',
         #  'Sample Name',
         #  'Gene Name',
         #  'Condition Name',
@@ -107,7 +242,7 @@ class Data:
          'Sample Prep Notes',
          'Number'
          #,'Plate'
-          ], axis=1)
+          ], axis=1, errors='ignore')
         return df
 
     def rename_columns(self,df):
@@ -120,20 +255,29 @@ class Data:
         return df
 
     def add_columns(self,df):
+        # Condition and Bio Rep given by a plate layout are kept, names are only parsed for wells without them
+        if 'Condition' in df.columns and 'Bio Rep' in df.columns and df[['Condition', 'Bio Rep']].notna().all(axis=None):
+            return df
+
         # Add column to define condition
         sample_condition = asarray([re.sub("[^A-Z\d]", "", re.search("^[^_]*", i).group(0).upper()) for i in df['Sample']])
-        df['Condition'] = sample_condition
+        df['Condition'] = self.fill_column(df, 'Condition', sample_condition)
 
         # Add column to define bio replicate number
         # Old data does not have bio reps so if it doesn't (according to sample name) then bio rep set as 0
-        if re.search(r'([-\d]$)', df['Sample'][0]):
+        if len(df) and re.search(r'([-\d]$)', df['Sample'].iloc[0]):
             sample_bio_rep = asarray([re.sub("[^A-Z\d]", "", re.search(r'([-\d]$)', i).group(0).upper()) for i in df['Sample']])
         else:
             sample_bio_rep = asarray([0 for i in df['Sample']])
 
-        df['Bio Rep'] = sample_bio_rep
+        df['Bio Rep'] = self.fill_column(df, 'Bio Rep', sample_bio_rep)
         return df
 
+    def fill_column(self, df, column, parsed):
+        # Values parsed from sample names, except where the column already has one
+        if column not in df.columns: return parsed
+        return df[column].where(df[column].notna(), pd.Series(parsed, index=df.index))
+
 #--------------------------------------------------------------------------------
 # Analysing Cq data
     '''
@@ -158,13 +302,13 @@ class Data:
         return ref_target_mean_by_sample, ref_target_mean_by_treat
 
     def get_ref_mean( self, ref_mean_df, age, biorep, treatment ):
-        ref_mean_by_age = ref_mean_df.loc[[age, 'amean_cq']].reset_index()
+        ref_mean_by_age = ref_mean_df.loc[ref_mean_df.index.get_level_values(0) == age].reset_index()
         ref_mean_cq     = ref_mean_by_age[(ref_mean_by_age['Bio Rep'] == biorep) & (ref_mean_by_age['Treatment'] == treatment)]
         return ref_mean_cq
 
-    def get_ddcq( self, control_avg, sample):
+    def get_ddcq( self, control_avg, sample, base=2):
         dcq  = control_avg - sample
-        ddcq = float(power(2, dcq))
+        ddcq = float(power(base, dcq))
         return ddcq
 
     def amean_cq(self,seq):
@@ -176,24 +320,26 @@ class Data:
         gmean_cq = gmean(seq)
         return gmean_cq
 
+    def calibrate_plates(self,df):
+        """
+        Correct plate-to-plate Cq offsets using the shared calibrator samples, or the
+        control group wells if no calibrators were given. See calibration.py.
+        :return: Calibrated df and the per-plate offsets
+        :rtype: tuple(DataFrame, Series)
+        """
+        return calibration.calibrate(df, calibrators=self.calibrators, cntl_grp=self.cntl_grp)
+
     def concat_df(self,df_arr):
-        # Concatenates dataframes given as an list.
-        concatenated = pd.concat(df_arr, sort=False)
+        # Concatenates dataframes given as a list, or a generator so each can be freed once written.
+        # Rows are written into one PlateAccumulator rather than copied by pd.concat. See accumulator.py.
+        concatenated = accumulator.concat(df_arr)
         return concatenated
 
 #--------------------------------------------------------------------------------------------
     def calculate_mean_cq( self, df, ref_sample_grouped_by_age, ref_target_mean_by_sample ):
         # define conditions and initiate empty array and df
         unique_cond = df.Condition.unique()
-        mean_cq_df       = pd.DataFrame({
-                                   'Sample'   : [],
-                                   'Bio Rep'  : [],
-                                   'Target'   : [],
-                                   'Age'      : [],
-                                   'Mean Cq'  : [],
-                                   'Treatment': [],
-                                   'Plate'    : []
-                                  })
+        mean_cq_df       = PlateAccumulator(['Sample', 'Bio Rep', 'Target', 'Age', 'Mean Cq', 'Treatment', 'Plate'])
 
         # iterate through unique 'conditions' i.e. ages and NEG, calculate relative quantity, and
         for condition, group in ref_sample_grouped_by_age:
@@ -209,7 +355,7 @@ class Data:
 
                     # Normalise to reference gene and
                     # RQ = self.ddcq(ref_mean_cq, sample_mean_cq)
-                    mean_cq_df = mean_cq_df.append({
+                    mean_cq_df.append_row({
                                            'Sample'   : sample,
                                            'Bio Rep'  : biorep,
                                            'Target'   : group['Target'].unique()[0],
@@ -217,38 +363,63 @@ class Data:
                                            'Mean Cq'  : sample_mean_cq,
                                            'Treatment': treatment,
                                            'Plate'    : plate
-                                         },ignore_index=True)
+                                         })
 
-        return mean_cq_df
+        return mean_cq_df.frame()
 
     def get_average_cq_per_target_for_cntl_grps(self, df):
         """
         """
         filter_controls_only = df.loc[df['Treatment'] == self.cntl_grp].sort_values(by=['Plate', 'Target', 'Age']).drop('Bio Rep', axis=1)
+
+        if self.calibrate:
+            # Plates are on a common scale after calibration so controls are pooled across all plates
+            pooled_averaged  = filter_controls_only.groupby(['Age', 'Target'])[['Mean Cq']].agg(self.amean_cq)
+            plate_keys       = df[['Plate', 'Age', 'Target']].drop_duplicates()
+            grouped_averaged = plate_keys.join(pooled_averaged, on=['Age', 'Target']).set_index(['Plate', 'Age', 'Target']).sort_index()
+            return grouped_averaged
+
         grouped_averaged = filter_controls_only.groupby(['Plate', 'Age', 'Target']).agg(self.amean_cq)
         # group by age target and plate
 
         return grouped_averaged
 
-    def calculate_RQ(self):
+    def prepare_wells(self, tidied=None):
+        # Tidied wells of every plate in one frame, after melt curve QC and plate calibration.
+        # tidied is the output of tidy_each_experiment, if it has already been computed.
+        # Otherwise plates are tidied one at a time and written straight into the result.
+        if tidied is None: tidied = (self.tidy_plate(i) for i in self.plate_indices())
+        df = self.concat_df(self.exclude_failed_wells(t_df) for t_df in tidied)
+
+        # Remove plate-to-plate offsets before any averaging
+        if self.calibrate and len(self.fname_arr) > 1: df = self.calibrate_plates(df)[0]
+        return df
+
+    def calculate_RQ(self, df=None):
         """Description
         :param DataFrame sample_frame: A sample data frame.
         :param string ref_target: A string matching an entry of the Target column; reference gene;
             the target to use as the reference target (e.g. 'BACTIN')
+        :param DataFrame df: Output of prepare_wells, if it has already been computed.
         :return: A DataFrame with columns: Sample, Target, Age, DeltaCq, and Rel Exp.
         :rtype: DataFrame
         """
-        df       = self.tidy_each_experiment()
-        if len(df) > 1: df = self.concat_df(df)
-        n_plates = len(df)+1
+        if self.engine == 'streaming':
+            return streaming.calculate_RQ(self, self.plates_per_chunk)
+
+        if df is None: df = self.prepare_wells()
+
+        amplification = self.amplification_factors(df)
+        df            = self.drop_standards(df)
+
+        if self.engine == 'vectorized':
+            return engine.calculate_RQ(df, self.cntl_grp, pooled=self.calibrate, amplification=amplification)
 
         ref_gene = self.ref_gene
         relevant_cols = ['Sample', 'Cq', 'Condition', 'Bio Rep', 'Plate']
         relevant_grps = ['Condition', 'Sample', 'Bio Rep','Plate']
         if self.treated: relevant_cols.append('Treatment'); relevant_grps.append('Treatment')
 
-        if isinstance(df,type(list)): df = df[0] #if only one plate
-
         ref_target_mean_by_sample, ref_target_mean_by_treat = self.get_ref_data(df, relevant_cols, relevant_grps)
 
         ref_sample_grouped_by_age = df.groupby(relevant_grps)
@@ -268,8 +439,9 @@ class Data:
             mean_cq = sample['Mean Cq']
 
             avg_control_cq = avg_control_cq_df.loc[plate, age, target]
+            base           = 2 if amplification is None else amplification.get(target, 2)
 
-            RQ = self.get_ddcq(avg_control_cq, mean_cq)
+            RQ = self.get_ddcq(avg_control_cq, mean_cq, base)
 
             RQ_list.append(RQ)
 
@@ -278,67 +450,69 @@ class Data:
 
         return results_df
 
-    def normalise_to_bio_ref(self):
+    def normalise_to_bio_ref(self, rq_df=None, select=None):
         # normalisation factor is the experimentally relevant group such as untreated control
         # or a particular target gene that your final results will be relative to
+        # rq_df is the output of calculate_RQ, if it has already been computed
+        # select picks the normalised rows to average, if not all (see Query.normalise_to_bio_ref)
 #         rq_df_no_refgene = rq_df.groupby(['Target', 'Age', 'Treatment']).agg(self.amean_cq).reset_index()
 
-        rq_df            = self.calculate_RQ()
-        rq_df_no_refgene = rq_df[rq_df.Target != 'BACTIN']
+        if rq_df is None: rq_df = self.calculate_RQ()
+
+        if self.engine in ['vectorized', 'streaming']:
+            return engine.normalise_to_bio_ref(rq_df, self.ref_gene, self.bio_ref, self.cntl_grp,
+                                               pooled=self.calibrate, select=select)
+
+        rq_df_no_refgene = rq_df[rq_df.Target != self.ref_gene]
 #         rq_df_no_refgene = rq_df
 
         nf_age           = self.bio_ref[0]
         nf_target        = self.bio_ref[1]
-        get_nf_untreated = rq_df_no_refgene[(rq_df_no_refgene['Age'] == nf_age) & (rq_df_no_refgene['Target'] == nf_target) & (rq_df_no_refgene['Treatment'] == 'Non Gravel')].reset_index()
-        get_nf_treated   = rq_df_no_refgene[(rq_df_no_refgene['Age'] == nf_age) & (rq_df_no_refgene['Target'] == nf_target) & (rq_df_no_refgene['Treatment'] == 'Gravel')].reset_index()
-        avg_RQs          = rq_df_no_refgene['RQ']
-
-        n_bio_reps         = len(rq_df['Bio Rep'].unique())
-
-        nf_untreated = get_nf_untreated['Treatment'][0]
-        nf_treated   = get_nf_treated['Treatment'][0]
-
-#         print(get_nf_untreated, get_nf_treated)
-
-#         print(rq_df_no_refgene)
-
 
-        norm_df = pd.DataFrame({
-                                'Target'      : [],
-                                'Sample'      : [],
-                                'Age'         : [],
-                                'Treatment'   : [],
-                                'norm_RQ'     : [], # A
-                                'log(norm_RQ)': [], # B
-#                                 'norm_RQ_mean': [], # C
-#                                 'log(norm_RQ_mean)': [], # D
-#                                 'SD(log(norm_RQ))': [], # E
-                               })
-
-        for i, sample in rq_df_no_refgene.iterrows():
+        # Bio ref RQ of each Treatment and Bio Rep (the first plate's, if it was run on several),
+        # joined on rather than looked up by position, since sample names needn't sort by bio rep
+        get_nf   = rq_df_no_refgene[(rq_df_no_refgene['Age'] == nf_age) & (rq_df_no_refgene['Target'] == nf_target)]
+        get_nf   = get_nf.sort_values('Plate', kind='mergesort').drop_duplicates(['Treatment', 'Bio Rep'])
+        nf_by_rq = rq_df_no_refgene.merge(get_nf[['Treatment', 'Bio Rep', 'RQ']].rename(columns={'RQ': 'nf RQ'}),
+                                          on=['Treatment', 'Bio Rep'], how='left')
+
+        norm_df = PlateAccumulator([
+                                'Target',
+                                'Sample',
+                                'Bio Rep',
+                                'Age',
+                                'Treatment',
+                                'Plate',
+                                'norm_RQ', # A
+                                'log(norm_RQ)', # B
+#                                 'norm_RQ_mean', # C
+#                                 'log(norm_RQ_mean)', # D
+#                                 'SD(log(norm_RQ))', # E
+                               ])
+
+        for i, sample in nf_by_rq.iterrows():
             sample_RQ = sample['RQ']
-            sample_biorep = int(sample['Bio Rep'])
-
-            # If the sample has been treated then compare with treated normalisation factor average
-            if sample['Treatment'] == nf_untreated:
-                n_RQ = sample_RQ/get_nf_untreated['RQ'][sample_biorep-1]
 
-            elif sample['Treatment'] == nf_treated:
-                n_RQ = sample_RQ/get_nf_treated['RQ'][sample_biorep-1]
+            # Each sample is compared with the bio ref of its own treatment (e.g. treated with treated) and bio rep
+            n_RQ = sample_RQ/sample['nf RQ']
 
             log2_norm_exp = self.log2(n_RQ)
 
-            norm_df = norm_df.append({
+            norm_df.append_row({
                                     'Target'      : sample['Target'],
                                     'Sample'      : sample['Sample'],
+                                    'Bio Rep'     : sample['Bio Rep'],
                                     'Age'         : sample['Age'],
                                     'Treatment'   : sample['Treatment'],
+                                    'Plate'       : sample['Plate'],
                                     'norm_RQ'     : n_RQ, # A
                                     'log(norm_RQ)': log2_norm_exp, # B
 #                                     'norm_RQ_mean': [], # C
 #                                     'log(norm_RQ_mean)': [], # D
 #                                     'SD(log(norm_RQ))': [], # E
-                                    },ignore_index=True)
+                                    })
+        norm_df = norm_df.frame()
+        if select is not None: norm_df = select(norm_df)
 
 
         # Bio group expression gmean of
@@ -352,33 +526,142 @@ class Data:
 
     def calculate_sd_sem(self, norm_df):
 #         norm_df = self.normalise_to_bio_ref()[0]
-        sd_df = norm_df.groupby(['Target', 'Age', 'Treatment']).sem() #agg({'log(norm_RQ)': 'sem' })
+        # Only the normalised values; the SEM of the propagated SE columns (or of Plate) means nothing
+        sd_df = norm_df.groupby(['Target', 'Age', 'Treatment'])[['norm_RQ', 'log(norm_RQ)']].sem() #agg({'log(norm_RQ)': 'sem' })
         return sd_df
 
+    def compare_treatments(self, method='welch', n_perm=10000, seed=None, norm_df=None):
+        """
+        Test each treatment against the control group on log2(norm_RQ), for every Target
+        and Age at once, with Benjamini-Hochberg correction. See significance.py.
+        :param string method: 'welch' or 'permutation'.
+        :param DataFrame norm_df: First output of normalise_to_bio_ref, if already computed.
+        :rtype: DataFrame
+        """
+        if norm_df is None: norm_df = self.normalise_to_bio_ref()[0]
+        norm_df = norm_df.loc[norm_df['Age'] != 'NEG']
+        return significance.compare_treatments(norm_df, self.cntl_grp, method=method, n_perm=n_perm, seed=seed)
+
+    def compute(self, outputs, max_workers=4, executor='thread'):
+        """
+        Compute several outputs at once, e.g. ['plot_RQ', 'plot_norm_RQ', 'sem'], running
+        independent stages concurrently and every shared stage only once. See scheduler.py.
+        :param string executor: 'thread' or 'process'.
+        :return: Output name -> result
+        :rtype: dict
+        """
+        return scheduler.Scheduler(self, max_workers, executor).run(outputs)
+
+    def design_power(self, n_bio=(3, 4, 5, 6, 8), n_tech=(2, 3, 4), fold_change=(1.5, 2), n_sims=5000, alpha=0.05, seed=0):
+        """
+        Simulated power of designs with n_bio bio reps and n_tech tech reps to detect each
+        fold change, given the replicate variance of this experiment. See sample_size.py.
+        :rtype: DataFrame
+        """
+        components = sample_size.variance_components(self.prepare_wells()).iloc[0]
+        return sample_size.power_table(components['Tech Var'], components['Bio Var'], n_bio, n_tech, fold_change, n_sims, alpha, seed=seed)
+
+#-------------------------------------------------------------------------------------------
+# Standard curves and absolute quantification
+
+    def standard_curve_sums(self, df=None):
+        # Sums of the standard curve fits per Plate and Target, chunk by chunk when streaming
+        if self.standards is None:
+            raise ValueError('Standard curves need the known quantities of the dilution series, see standards.')
+        if df is not None:
+            return standard_curve.curve_sums(df, self.standards)
+        if self.engine == 'streaming':
+            return standard_curve.merge_sums([standard_curve.curve_sums(chunk, self.standards)
+                                              for chunk in streaming.iter_chunks(self, self.plates_per_chunk)])
+        return standard_curve.curve_sums(self.prepare_wells(), self.standards)
+
+    def standard_curves(self):
+        """
+        Slope, intercept, R2, amplification factor and efficiency of the standard curve of
+        every Plate and Target. See standard_curve.py.
+        :rtype: DataFrame
+        """
+        return standard_curve.fit(self.standard_curve_sums())
+
+    def amplification_factors(self, df=None):
+        """
+        Amplification factor per Target used for RQ, or None for 100% efficiency. With
+        efficiency='standards' it is fitted from the standard curves of all plates.
+        :rtype: Series
+        """
+        if self.efficiency is None: return None
+        if isinstance(self.efficiency, str):
+            if self.efficiency != 'standards':
+                raise ValueError("efficiency must be None, 'standards' or amplification factors per target, got '{}'".format(self.efficiency))
+            return standard_curve.target_amplification(self.standard_curve_sums(df))
+        return pd.Series(self.efficiency, dtype=float)
+
+    def drop_standards(self, df):
+        # The dilution series has no control group, so it is left out of RQ
+        if self.standards is None: return df
+        return df.loc[~df['Sample'].isin(list(self.standards))]
+
+    def absolute_quantities(self):
+        """
+        Mean Cq of every sample read off the standard curve of its Plate and Target.
+        :return: Rows of engine.mean_cq with log10(Quantity) and Quantity
+        :rtype: DataFrame
+        """
+        if self.engine == 'streaming':
+            mean_cq_df = streaming.stream_mean_cq(self, self.plates_per_chunk)
+            curves     = self.standard_curves()
+        else:
+            df         = self.prepare_wells()
+            mean_cq_df = engine.mean_cq(df)
+            curves     = standard_curve.fit(self.standard_curve_sums(df))
+        return standard_curve.quantify(mean_cq_df, curves)
+
+#-------------------------------------------------------------------------------------------
+# Storing results
+
+    def save_results(self, db, experiment=None, manifest=None):
+        """
+        Store the tidied wells, RQ and normalised RQ of this experiment in a results
+        database, replacing anything stored for it before, along with a manifest of the
+        inputs, parameters and code they came from. See results_db.py and manifests.py.
+        :param db: A ResultsDB or the file name of one.
+        :param string experiment: Name to store it under. Defaults to self.experiment.
+        :param dict manifest: Output of manifests.build, if already made.
+        :rtype: ResultsDB
+        """
+        if isinstance(db, str): db = ResultsDB(db)
+        if experiment is None: experiment = self.experiment
+        if manifest is None: manifest = manifests.build(self, db.manifest(experiment))
+
+        results  = self.compute(['tidy', 'rq', 'norm_rq'])
+        wells    = self.concat_df(results['tidy'])
+        manifest = manifests.finish(manifest, wells=wells, rq=results['rq'], norm_rq=results['norm_rq'])
+
+        db.store(experiment, wells=wells, rq=results['rq'], norm_rq=results['norm_rq'], manifest=manifest)
+        return db
+
 #-------------------------------------------------------------------------------------------
 # Plotting functions
 
-    def plot_raw_cq(self):
-        df = self.tidy_each_experiment()
-        if len(df) > 1: df = self.concat_df(df)
+    def plot_raw_cq(self, tidied=None):
+        df = self.tidy_each_experiment() if tidied is None else tidied
+        df = self.concat_df(df) if len(df) > 1 else df[0]
 
         sns.set(context='paper', style='whitegrid', palette="ch:7.1,-.2,dark=.3", font='sans-serif', font_scale=1.5, color_codes=True, rc=None)
         g = sns.catplot(x="Target", y="Cq", col="Condition", hue='Treatment', hue_order=['Non Gravel','Gravel'], data=df, saturation=.5, kind="bar", ci='sd', aspect=.6)
         (g.set_axis_labels("", "Cq").set_xticklabels(rotation=45).set_titles("{col_name}").despine(left=True))
         return g
 
-    def plot_RQ(self):
-        df = self.tidy_each_experiment()
-        df = self.strip_controls(self.calculate_RQ())
+    def plot_RQ(self, rq_df=None):
+        df = self.strip_controls(self.calculate_RQ() if rq_df is None else rq_df)
 
         sns.set(context='paper', style='whitegrid', palette="ch:7.1,-.2,dark=.3", font='sans-serif', font_scale=1.5, color_codes=True, rc=None)
         g = sns.catplot(x="Target", y="RQ", col="Age", hue='Treatment', hue_order=['Non Gravel','Gravel'], data=df, saturation=.5, kind="bar", ci='sd', aspect=.6)
         (g.set_axis_labels("", "RQ").set_xticklabels(rotation=45).set_titles("{col_name}").despine(left=True))
         return g
 
-    def plot_norm_RQ(self):
-        df = self.tidy_each_experiment()
-        df = self.strip_controls(self.normalise_to_bio_ref()[1])
+    def plot_norm_RQ(self, norm_df_mean=None):
+        df = self.strip_controls(self.normalise_to_bio_ref()[1] if norm_df_mean is None else norm_df_mean)
 #         df = df.loc[(df['Target'] == 'GRIN2AB')]
 
         sns.set(context='paper', style='whitegrid', palette="ch:7.1,-.2,dark=.3", font='sans-serif', font_scale=1.5, color_codes=True, rc=None)
@@ -387,7 +670,7 @@ class Data:
         return g
 
     def strip_controls(self,df):
-        stripped = df.loc[(df['Target'] != 'BACTIN') & (df['Age'] != 'NEG')]
+        stripped = df.loc[(df['Target'] != self.ref_gene) & (df['Age'] != 'NEG')]
         sort_d   = stripped.sort_values(['Target','Age','Treatment']).reset_index(drop=True)
         return sort_d
 
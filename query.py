@@ -0,0 +1,176 @@
+import copy
+import pandas as pd, numpy as np
+
+#--------------------------------------------------------------------------------
+# Lazy queries over a Data pipeline
+#
+# Data.query(target=..., age=..., treatment=..., plate=...) only records the filters.
+# Nothing is read until a stage is asked for, and then the filters are pushed down
+# into reading: plates that can't contribute are never opened, and rows of other
+# targets are dropped as soon as a plate is read, before tidying or Cq calling.
+# Rows needed for the answer to be the same as filtering the full analysis are
+# pulled in automatically:
+#
+#   - the control group (cntl_grp) of every selected Age and Target, for RQ
+#   - the reference gene (ref_gene), which the loop engine reads while averaging
+#   - the bio ref (Age and Target of bio_ref) of every plate and treatment, for normalisation
+#
+# and taken out again before results are returned. With plate calibration or
+# efficiency='standards' every plate is read in full.
+#
+#   data.query(target='GRIN2AB', age=['3', '5']).normalise_to_bio_ref()
+#   data.query(treatment='Gravel').filter(plate=2).explain()
+
+# Query filter -> column of the tidied wells it applies to
+FILTERS = {'target': 'Target', 'age': 'Condition', 'treatment': 'Treatment', 'plate': 'Plate'}
+
+def as_set(values):
+    # None means anything, otherwise one value or a list of them; labels compare as text, plates as numbers
+    if values is None: return None
+    if isinstance(values, str) or not hasattr(values, '__iter__'): values = [values]
+    return set(values)
+
+def normalise_filter( key, values ):
+    values = as_set(values)
+    if values is None: return None
+    return {int(v) for v in values} if key == 'plate' else {str(v) for v in values}
+
+class Pushdown:
+    """
+    Rows to read, as a union of clauses. A clause maps columns of the tidied wells to the
+    values allowed in them (None for any value). Set on a Data object as data.pushdown.
+    """
+    def __init__( self, clauses ):
+        self.clauses = clauses
+
+    def for_plate( self, plate ):
+        return [c for c in self.clauses if c['Plate'] is None or plate in c['Plate']]
+
+    def plates( self, n_plates ):
+        # Indices of the plates any clause can match
+        return [i for i in range(n_plates) if self.for_plate(i+1)]
+
+    def mask( self, columns, plate ):
+        # columns: column name -> its values as text
+        keep = np.zeros(len(next(iter(columns.values()))), dtype=bool)
+        for clause in self.for_plate(plate):
+            match = keep | True
+            for column, values in columns.items():
+                if clause[column] is not None: match &= values.isin(clause[column]).to_numpy()
+            keep |= match
+        return keep
+
+    def early( self, df, i ):
+        # Straight after reading, only Target is known, still untrimmed
+        keep = self.mask({'Target': df['Target'].astype(str).str.strip()}, i+1)
+        return df.loc[keep].reset_index(drop=True)
+
+    def late( self, df, i ):
+        # After tidying, with Condition and the title-cased Treatment
+        keep = self.mask({column: df[column].astype(str) for column in ['Target', 'Condition', 'Treatment']}, i+1)
+        return df.loc[keep]
+
+    def describe( self, fname_arr ):
+        rows = []
+        for i in self.plates(len(fname_arr)):
+            for clause in self.for_plate(i+1):
+                rows.append({'Plate': i+1, 'File': fname_arr[i],
+                             **{column: 'any' if clause[column] is None else sorted(clause[column]) for column in ['Target', 'Condition', 'Treatment']}})
+        return pd.DataFrame(rows)
+
+class Query:
+    def __init__( self, data, **filters ):
+        unknown = set(filters) - set(FILTERS)
+        if unknown: raise ValueError('Unknown filters {}, expected some of {}'.format(sorted(unknown), list(FILTERS)))
+        self.data    = data
+        self.filters = {key: normalise_filter(key, filters.get(key)) for key in FILTERS}
+
+    def filter( self, **filters ):
+        """
+        A narrower query: rows must also match these filters.
+        :rtype: Query
+        """
+        narrowed = Query(self.data, **filters)
+        for key, values in self.filters.items():
+            if values is None: continue
+            narrowed.filters[key] = values if narrowed.filters[key] is None else values & narrowed.filters[key]
+        return narrowed
+
+    def clauses( self, normalise=True ):
+        f, data = self.filters, self.data
+        with_controls = None if f['treatment'] is None else f['treatment'] | {data.cntl_grp}
+        with_ref_gene = None if f['target'] is None else f['target'] | ({data.ref_gene} if data.engine == 'loop' else set())
+
+        selected = {
+                    'Target'   : with_ref_gene,
+                    'Condition': f['age'],
+                    'Treatment': with_controls,
+                    'Plate'    : f['plate'],
+                   }
+        if not normalise: return [selected]
+
+        # Every treatment's bio ref, whichever treatments are selected: the normaliser reads them all
+        bio_ref  = {
+                    'Target'   : {str(data.bio_ref[1])},
+                    'Condition': {str(data.bio_ref[0])},
+                    'Treatment': None,
+                    'Plate'    : None,
+                   }
+        return [selected, bio_ref]
+
+    def plan( self, normalise=True ):
+        """
+        The pushdown used to compute a stage, or None if everything has to be read. Plate
+        calibration uses the calibrators of every plate, and efficiencies fitted from
+        standards use the dilution series of every plate, so neither is ever pruned.
+        :rtype: Pushdown
+        """
+        if self.data.calibrate or self.data.efficiency == 'standards': return None
+        return Pushdown(self.clauses(normalise))
+
+    def explain( self, normalise=True ):
+        """
+        Plates that will be read and the rows kept from each.
+        :rtype: DataFrame
+        """
+        plan = self.plan(normalise) or Pushdown([dict.fromkeys(['Target', 'Condition', 'Treatment', 'Plate'])])
+        return plan.describe(self.data.fname_arr)
+
+    def pruned( self, normalise=True ):
+        # A copy of the Data object that only reads what the plan needs
+        data          = copy.copy(self.data)
+        data.pushdown = self.plan(normalise)
+        return data
+
+    def select( self, df ):
+        # Apply the filters themselves, dropping the rows only pulled in for correctness
+        keep = pd.Series(True, index=df.index)
+        for key, values in self.filters.items():
+            column = FILTERS[key]
+            if column == 'Condition' and column not in df.columns: column = 'Age'
+            if values is None or column not in df.columns: continue
+            keep &= (df[column].astype(float).astype(int) if key == 'plate' else df[column].astype(str)).isin(values)
+        return df.loc[keep]
+
+    def wells(self):
+        """
+        Tidied wells of every selected plate in one frame, after melt curve QC and
+        plate calibration.
+        :rtype: DataFrame
+        """
+        return self.select(self.pruned(normalise=False).prepare_wells())
+
+    def calculate_RQ(self):
+        """
+        Data.calculate_RQ of the selected rows.
+        :rtype: DataFrame
+        """
+        return self.select(self.pruned(normalise=False).calculate_RQ())
+
+    def normalise_to_bio_ref(self):
+        """
+        Data.normalise_to_bio_ref of the selected rows. The means are taken over the
+        selected rows only.
+        :rtype: tuple(DataFrame, DataFrame)
+        """
+        return self.pruned().normalise_to_bio_ref(select=self.select)
@@ -0,0 +1,147 @@
+import sqlite3, json
+import pandas as pd, numpy as np
+
+#--------------------------------------------------------------------------------
+# SQLite store for results of many experiments
+#
+# Each Data stage gets a table with the same column names as the DataFrame it
+# comes from, plus the Experiment it belongs to:
+#
+#   wells   - tidied wells (Data.tidy_each_experiment), Condition stored as Age
+#   rq      - Mean Cq of the tech reps and RQ of each sample (Data.calculate_RQ)
+#   norm_rq - RQ normalised to the bio ref (Data.normalise_to_bio_ref)
+#
+# and the manifests table records how each experiment's results were made (see
+# manifests.py), so unchanged experiments needn't be analysed again.
+#
+# Storing an experiment replaces whatever was stored for it before, in a single
+# transaction, so re-running an analysis never leaves a mix of old and new rows.
+
+SCHEMA = {
+    'wells'  : [('Experiment', 'TEXT'), ('Plate', 'INTEGER'), ('Position', 'TEXT'), ('Sample', 'TEXT'), ('Bio Rep', 'INTEGER'),
+                ('Target', 'TEXT'), ('Age', 'TEXT'), ('Treatment', 'TEXT'), ('Cq', 'REAL')],
+    'rq'     : [('Experiment', 'TEXT'), ('Plate', 'INTEGER'), ('Sample', 'TEXT'), ('Bio Rep', 'INTEGER'), ('Target', 'TEXT'),
+                ('Age', 'TEXT'), ('Treatment', 'TEXT'), ('Mean Cq', 'REAL'), ('RQ', 'REAL')],
+    'norm_rq': [('Experiment', 'TEXT'), ('Plate', 'INTEGER'), ('Sample', 'TEXT'), ('Bio Rep', 'INTEGER'), ('Target', 'TEXT'),
+                ('Age', 'TEXT'), ('Treatment', 'TEXT'), ('norm_RQ', 'REAL'), ('log(norm_RQ)', 'REAL')],
+    'manifests': [('Experiment', 'TEXT'), ('Inputs Fingerprint', 'TEXT'), ('Outputs Fingerprint', 'TEXT'), ('Manifest', 'TEXT')],
+}
+
+INDEXED = ['Experiment', 'Target', 'Age', 'Treatment', 'Plate']
+
+# Keyword filters accepted by ResultsDB.query and the columns they apply to
+FILTERS = {
+    'experiment': 'Experiment',
+    'plate'     : 'Plate',
+    'sample'    : 'Sample',
+    'bio_rep'   : 'Bio Rep',
+    'target'    : 'Target',
+    'age'       : 'Age',
+    'treatment' : 'Treatment',
+}
+
+def quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+class ResultsDB:
+    def __init__( self, fname=':memory:' ):
+        self.fname = fname
+        self.con   = sqlite3.connect(fname)
+        self.create_tables()
+
+    def create_tables(self):
+        with self.con:
+            for table, columns in SCHEMA.items():
+                column_defs = ', '.join('{} {}'.format(quote(name), kind) for name, kind in columns)
+                self.con.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(table, column_defs))
+
+                # Databases made before a column was added to the schema get it, empty for the rows already stored
+                existing = {row[1] for row in self.con.execute('PRAGMA table_info({})'.format(table))}
+                for name, kind in columns:
+                    if name not in existing: self.con.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, quote(name), kind))
+
+                for column in INDEXED:
+                    if column not in dict(columns): continue
+                    index_name = 'ix_{}_{}'.format(table, column.lower().replace(' ', '_'))
+                    self.con.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(index_name, table, quote(column)))
+
+    def close(self):
+        self.con.close()
+
+    def rows( self, table, experiment, df ):
+        # DataFrame to a list of plain Python rows in schema order; missing columns and NaN become NULL
+        columns = [name for name, _ in SCHEMA[table]]
+        df      = df.rename(columns={'Condition': 'Age'}).reindex(columns=columns)
+        df['Experiment'] = experiment
+        df      = df.astype(object)
+        return df.where(df.notna(), None).to_numpy().tolist()
+
+    def store( self, experiment, wells=None, rq=None, norm_rq=None, manifest=None ):
+        """
+        Store the results of one experiment, replacing any earlier results for it. All
+        tables are written in one transaction.
+        :param string experiment: Name of the experiment, e.g. '200228_qPCR'.
+        :param DataFrame wells: Tidied wells.
+        :param DataFrame rq: Output of Data.calculate_RQ.
+        :param DataFrame norm_rq: First output of Data.normalise_to_bio_ref.
+        :param dict manifest: Output of manifests.build, with the outputs' fingerprint.
+        """
+        frames = {'wells': wells, 'rq': rq, 'norm_rq': norm_rq}
+        if manifest is not None:
+            frames['manifests'] = pd.DataFrame([{'Inputs Fingerprint' : manifest['Inputs Fingerprint'],
+                                                 'Outputs Fingerprint': manifest['Outputs Fingerprint'],
+                                                 'Manifest'           : json.dumps(manifest, sort_keys=True)}])
+        with self.con:
+            for table, df in frames.items():
+                if df is None: continue
+                columns = [name for name, _ in SCHEMA[table]]
+                self.con.execute('DELETE FROM {} WHERE "Experiment" = ?'.format(table), (experiment,))
+                self.con.executemany('INSERT INTO {} ({}) VALUES ({})'.format(table, ', '.join(quote(c) for c in columns), ', '.join('?'*len(columns))),
+                                     self.rows(table, experiment, df))
+
+    def query( self, table, columns=None, **filters ):
+        """
+        Select rows from one table, e.g. query('rq', target='GRIN2AA', age='5', experiment='20%').
+        Filters are ANDed. A list matches any of its values, and a string containing % is
+        matched with LIKE.
+        :param string table: 'wells', 'rq', 'norm_rq' or 'manifests'.
+        :param list columns: Columns to return. Defaults to all of them.
+        :rtype: DataFrame
+        """
+        if table not in SCHEMA: raise ValueError('Unknown table {}, expected one of {}'.format(table, list(SCHEMA)))
+
+        # SQLite reads a double-quoted name that isn't a column as a string, so unknown columns would match nothing
+        schema  = [name for name, _ in SCHEMA[table]]
+        unknown = [c for c in columns or [] if c not in schema]
+        if unknown: raise ValueError('Table {} has no columns {}, expected some of {}'.format(table, unknown, schema))
+
+        clauses, params = [], []
+        for key, value in filters.items():
+            if key not in FILTERS: raise TypeError('Unknown filter {}, expected one of {}'.format(key, list(FILTERS)))
+            if FILTERS[key] not in schema: raise ValueError('Table {} has no {} column to filter on'.format(table, FILTERS[key]))
+            column = quote(FILTERS[key])
+            if isinstance(value, (list, tuple, set, np.ndarray, pd.Series)):
+                value = list(value)
+                clauses.append('{} IN ({})'.format(column, ', '.join('?'*len(value))))
+                params += value
+            elif isinstance(value, str) and '%' in value:
+                clauses.append('{} LIKE ?'.format(column))
+                params.append(value)
+            else:
+                clauses.append('{} = ?'.format(column))
+                params.append(value)
+
+        select = ', '.join(quote(c) for c in columns) if columns else '*'
+        sql    = 'SELECT {} FROM {}'.format(select, table)
+        if clauses: sql += ' WHERE ' + ' AND '.join(clauses)
+        return pd.read_sql_query(sql, self.con, params=params)
+
+    def manifest( self, experiment ):
+        # The manifest stored with an experiment's results, or None
+        rows = self.query('manifests', ['Manifest'], experiment=experiment)
+        return json.loads(rows['Manifest'][0]) if len(rows) else None
+
+    def experiments(self):
+        # Names of all stored experiments
+        return pd.read_sql_query('SELECT DISTINCT "Experiment" FROM wells UNION SELECT DISTINCT "Experiment" FROM rq '
+                                 'UNION SELECT DISTINCT "Experiment" FROM norm_rq', self.con)['Experiment'].tolist()
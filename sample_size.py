@@ -0,0 +1,144 @@
+import argparse, itertools
+import pandas as pd, numpy as np
+
+import engine, significance
+
+#--------------------------------------------------------------------------------
+# Power and sample size by simulation
+#
+# Cq of a well is modelled as
+#
+#     Cq = mu + effect + bio + tech,   bio ~ N(0, Bio Var) per bio rep,  tech ~ N(0, Tech Var) per well
+#
+# with the variance components estimated from tidied wells of a past experiment
+# (e.g. test.csv). For a design of n_bio bio reps and n_tech tech reps per group,
+# n_sims experiments are drawn at once as (n_sims x n_bio x n_tech) arrays and
+# put through the steps of engine.relative_quantity and engine.normalise_to_bio_ref
+# as array operations:
+#
+#   Mean Cq  m     = mean over tech reps
+#   log2 RQ        = mean of control m - m
+#   log2 norm RQ   = log2 RQ - log2 RQ of the bio ref with the same treatment and bio rep
+#
+# then treated and control are compared with the same Welch test as
+# Data.compare_treatments. Power is the fraction of experiments with p < alpha.
+#
+#   python sample_size.py test.csv --fold-change 1.5 2 --bio-reps 3 4 6 --tech-reps 2 3
+
+def variance_components( df, by=None ):
+    """
+    Tech rep and bio rep variance of Cq, by method of moments. The tech variance is the
+    pooled variance within samples. The bio variance is the pooled variance of sample
+    means within a Plate, Age, Target and Treatment, less the part due to tech reps.
+    NEG and undetermined wells are left out.
+    :param DataFrame df: Tidied wells.
+    :param by: Column(s) to estimate separately for, e.g. 'Target'. Pooled over everything if None.
+    :return: Tech Var, Bio Var and the number of samples they came from
+    :rtype: DataFrame
+    """
+    wells      = df.loc[(df['Cq'] > 0) & (df['Condition'] != 'NEG')]
+    mean_cq_df = engine.mean_cq(wells)
+    mean_cq_df = mean_cq_df.loc[mean_cq_df['n'] > 0]
+
+    group      = ['Plate', 'Age', 'Target', 'Treatment']
+    k          = mean_cq_df.groupby(group)['Mean Cq'].transform('count')
+    mean_cq_df = mean_cq_df.assign(
+                                   tech_ss = (mean_cq_df['Cq Var']*(mean_cq_df['n'] - 1)).fillna(0),
+                                   tech_df = mean_cq_df['n'] - 1,
+                                   bio_ss  = (mean_cq_df['Mean Cq'] - mean_cq_df.groupby(group)['Mean Cq'].transform('mean'))**2,
+                                   bio_df  = (k - 1)/k,
+                                   inv_n   = 1/mean_cq_df['n'],
+                                  )
+
+    keys = np.zeros(len(mean_cq_df), dtype=int) if by is None else by
+    sums = mean_cq_df.groupby(keys)[['tech_ss', 'tech_df', 'bio_ss', 'bio_df', 'inv_n']].sum()
+    n    = mean_cq_df.groupby(keys).size()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tech_var = sums['tech_ss']/sums['tech_df']
+        between  = sums['bio_ss']/sums['bio_df']
+    bio_var = np.maximum(between - tech_var*sums['inv_n']/n, 0)
+
+    components = pd.DataFrame({'Tech Var': tech_var, 'Bio Var': bio_var, 'Samples': n})
+    return components.reset_index(drop=by is None)
+
+def simulate_mean_cq( rng, n_sims, n_bio, n_tech, tech_var, bio_var, shift=0 ):
+    # Mean Cq of n_bio samples in each of n_sims experiments
+    bio  = rng.normal(0, np.sqrt(bio_var), (n_sims, n_bio, 1))
+    tech = rng.normal(0, np.sqrt(tech_var), (n_sims, n_bio, n_tech))
+    return (shift + bio + tech).mean(axis=2)
+
+def simulate( n_bio, n_tech, fold_change, tech_var, bio_var, n_sims=5000, alpha=0.05, normalise=True, seed=None ):
+    """
+    Simulate n_sims experiments of one design and test treated against control in each.
+    :param int n_bio: Bio reps per treatment.
+    :param int n_tech: Tech reps per sample.
+    :param float fold_change: True treated/control expression ratio (2 = doubled).
+    :param bool normalise: Also normalise to a bio ref sample per treatment and bio rep,
+        which adds its noise as in Data.normalise_to_bio_ref.
+    :return: Power, and the mean and SD of the estimated log2 fold change
+    :rtype: dict
+    """
+    rng   = np.random.default_rng(seed)
+    draw  = lambda shift=0: simulate_mean_cq(rng, n_sims, n_bio, n_tech, tech_var, bio_var, shift)
+
+    # More expression means a lower Cq
+    control, treated = draw(), draw(-np.log2(fold_change))
+    control_avg      = control.mean(axis=1, keepdims=True)
+    log2_rq          = {'control': control_avg - control, 'treated': control_avg - treated}
+
+    if normalise:
+        # The bio ref has its own control average, and no treatment effect
+        ref         = {'control': draw(), 'treated': draw()}
+        ref_avg     = ref['control'].mean(axis=1, keepdims=True)
+        log2_rq     = {group: log2_rq[group] - (ref_avg - ref[group]) for group in log2_rq}
+
+    diff, _, _, p = significance.welch(log2_rq['treated'], log2_rq['control'])
+    return {
+            'Power'          : np.mean(p < alpha),
+            'Mean log2 FC'   : np.nanmean(diff),
+            'SD log2 FC'     : np.nanstd(diff, ddof=1),
+           }
+
+def power_table( tech_var, bio_var, n_bio=(3, 4, 5, 6, 8), n_tech=(2, 3, 4), fold_change=(1.5, 2), n_sims=5000,
+                 alpha=0.05, normalise=True, seed=0 ):
+    """
+    Power of every combination of bio reps, tech reps and fold change.
+    :return: One row per design, with the number of wells it needs per target and age
+    :rtype: DataFrame
+    """
+    rows = []
+    for i, (fc, b, t) in enumerate(itertools.product(fold_change, n_bio, n_tech)):
+        result = simulate(b, t, fc, tech_var, bio_var, n_sims, alpha, normalise, seed=None if seed is None else seed + i)
+        rows.append({'Fold Change': fc, 'Bio Reps': b, 'Tech Reps': t, 'Wells': 2*b*t*(2 if normalise else 1), **result})
+    return pd.DataFrame(rows)
+
+def smallest_designs( table, target_power=0.8 ):
+    """
+    The design with the fewest wells reaching target_power for each fold change.
+    :rtype: DataFrame
+    """
+    enough = table.loc[table['Power'] >= target_power]
+    return enough.sort_values(['Fold Change', 'Wells', 'Bio Reps'], ascending=[True, True, False]).drop_duplicates('Fold Change')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Power of qPCR designs, simulated from the replicate variance of past wells.')
+    parser.add_argument('wells', help='Tidied well file such as test.csv')
+    parser.add_argument('--fold-change', type=float, nargs='+', default=[1.5, 2])
+    parser.add_argument('--bio-reps', type=int, nargs='+', default=[3, 4, 5, 6, 8])
+    parser.add_argument('--tech-reps', type=int, nargs='+', default=[2, 3, 4])
+    parser.add_argument('--sims', type=int, default=5000)
+    parser.add_argument('--alpha', type=float, default=0.05)
+    parser.add_argument('--power', type=float, default=0.8, help='Power wanted')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    df         = pd.read_csv(args.wells, index_col=0, dtype={'Condition': str, 'Bio Rep': str})
+    components = variance_components(df)
+    print(components.to_string(index=False))
+
+    table = power_table(components['Tech Var'][0], components['Bio Var'][0], args.bio_reps, args.tech_reps, args.fold_change,
+                        args.sims, args.alpha, seed=args.seed)
+    print(table.to_string(index=False))
+    smallest = smallest_designs(table, args.power)
+    print(smallest.to_string(index=False) if len(smallest) else 'No design reaches a power of {}'.format(args.power))
@@ -0,0 +1,107 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import standard_curve
+
+#--------------------------------------------------------------------------------
+# Concurrent stage scheduler
+#
+# The stages of an analysis form a DAG: everything starts from the tidied plates,
+# RQ needs the prepared wells, normalisation needs RQ, and the figures and tests hang
+# off those. Asking for a set of outputs runs every stage they need exactly once,
+# each as soon as its inputs are ready, on a pool of at most max_workers threads
+# (or processes). Upstream results are handed to the stages that need them rather
+# than recomputed, and are kept for later requests.
+#
+#   Scheduler(data, max_workers=4).run(['plot_RQ', 'plot_norm_RQ', 'sem', 'compare'])
+#
+# Stage functions must not modify their inputs, since several stages may read them
+# at once. pyplot isn't thread safe, so figures are drawn one at a time on threads;
+# on processes they are drawn in parallel and come back pickled.
+
+# Stage -> (stages it needs, function of a Data and the outputs of those stages)
+STAGES = OrderedDict([
+    ('tidy'           , ([],          lambda data: data.tidy_each_experiment())),
+    ('wells'          , (['tidy'],    lambda data, tidied: data.prepare_wells(tidied))),
+    ('rq'             , (['wells'],   lambda data, wells=None: data.calculate_RQ(wells))),
+    ('norm'           , (['rq'],      lambda data, rq_df: data.normalise_to_bio_ref(rq_df))),
+    ('norm_rq'        , (['norm'],    lambda data, norm: norm[0])),
+    ('norm_rq_mean'   , (['norm'],    lambda data, norm: norm[1])),
+    ('sem'            , (['norm'],    lambda data, norm: data.calculate_sd_sem(norm[0]))),
+    ('compare'        , (['norm'],    lambda data, norm: data.compare_treatments(norm_df=norm[0]))),
+    ('standard_curves', (['wells'],   lambda data, wells: standard_curve.fit(data.standard_curve_sums(wells)))),
+    ('plot_raw_cq'    , (['tidy'],    lambda data, tidied: data.plot_raw_cq(tidied))),
+    ('plot_RQ'        , (['rq'],      lambda data, rq_df: data.plot_RQ(rq_df))),
+    ('plot_norm_RQ'   , (['norm'],    lambda data, norm: data.plot_norm_RQ(norm[1]))),
+])
+
+PLOT_LOCK = threading.Lock()
+
+def requires( stage, data ):
+    # The streaming engine reads plates itself, chunk by chunk, rather than from the prepared wells
+    if stage == 'rq' and data.engine == 'streaming': return []
+    return STAGES[stage][0]
+
+def run_stage( stage, data, *inputs ):
+    # Module level, so process pools can pickle it and find the stage by name
+    return STAGES[stage][1](data, *inputs)
+
+def run_plot( stage, data, *inputs ):
+    with PLOT_LOCK:
+        return run_stage(stage, data, *inputs)
+
+class Scheduler:
+    def __init__( self, data, max_workers=4, executor='thread' ):
+        if executor not in ['thread', 'process']:
+            raise ValueError("executor must be 'thread' or 'process', got '{}'".format(executor))
+        self.data        = data
+        self.max_workers = max_workers
+        self.executor    = executor
+        self.results     = {}
+
+    def needed( self, outputs ):
+        """
+        Every stage the outputs depend on that hasn't been computed yet, inputs first.
+        :rtype: list
+        """
+        order, seen = [], set()
+        def visit(stage):
+            if stage not in STAGES: raise KeyError('Unknown stage {}, expected one of {}'.format(stage, list(STAGES)))
+            if stage in seen or stage in self.results: return
+            seen.add(stage)
+            for dependency in requires(stage, self.data): visit(dependency)
+            order.append(stage)
+        for stage in outputs: visit(stage)
+        return order
+
+    def run( self, outputs ):
+        """
+        Compute the outputs, running independent stages concurrently.
+        :param list outputs: Names of STAGES.
+        :return: Output name -> result
+        :rtype: dict
+        """
+        if isinstance(outputs, str): outputs = [outputs]
+        pending = self.needed(outputs)
+        pool    = ThreadPoolExecutor if self.executor == 'thread' else ProcessPoolExecutor
+
+        with pool(max_workers=self.max_workers) as executor:
+            running = {}
+            while pending or running:
+                for stage in [s for s in pending if all(d in self.results for d in requires(s, self.data))]:
+                    pending.remove(stage)
+                    inputs = [self.results[d] for d in requires(stage, self.data)]
+                    call   = run_plot if stage.startswith('plot_') and self.executor == 'thread' else run_stage
+                    running[executor.submit(call, stage, self.data, *inputs)] = stage
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    try:
+                        self.results[stage] = future.result()
+                    except Exception:
+                        for other in running: other.cancel()
+                        raise
+
+        return {stage: self.results[stage] for stage in outputs}
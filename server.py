@@ -0,0 +1,251 @@
+import json, threading, argparse
+import pandas as pd
+
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, urlencode
+from urllib.request import urlopen, Request
+
+from qPCR import Data
+
+#--------------------------------------------------------------------------------
+# Local analysis server
+#
+# Keeps experiments and their computed stages in memory so repeated questions are
+# answered without re-importing anything or re-parsing plates. Listens on localhost
+# only. Stages are fetched with GET /<stage>?experiment=...&target=...&age=...,
+# where stage is one of STAGES below, and come back as JSON records (or CSV with
+# format=csv). Experiments are registered at start-up from a JSON config, or with
+# POST /experiments and a body of {"name": ..., "data_path": ..., ...Data arguments}.
+#
+#   python server.py experiments.json --port 8765
+
+class LRUCache:
+    def __init__( self, max_entries=64 ):
+        self.max_entries = max_entries
+        self.entries     = OrderedDict()
+        self.pending     = {} # key -> (Future, generation) of entries being computed
+        self.generations = {} # experiment -> times it has been evicted
+        self.hits        = 0
+        self.misses      = 0
+        self.lock        = threading.RLock()
+
+    def get_or_compute( self, key, compute ):
+        # The lock only guards the dicts. The first request for a missing entry computes it
+        # outside the lock and the others wait on its Future, so an entry is never built
+        # twice and requests for other entries aren't held up behind it.
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            if key in self.pending:
+                self.hits += 1
+                waiting = self.pending[key][0]
+            else:
+                self.misses += 1
+                waiting    = None
+                future     = Future()
+                generation = self.generations.get(key[0], 0)
+                self.pending[key] = (future, generation)
+
+        if waiting is not None: return waiting.result()
+
+        try:
+            value = compute()
+        except BaseException as e:
+            with self.lock:
+                if self.pending.get(key, (None,))[0] is future: del self.pending[key]
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            if self.pending.get(key, (None,))[0] is future: del self.pending[key]
+            # Not kept if the experiment was evicted (re-registered) while this was computed
+            if self.generations.get(key[0], 0) == generation:
+                self.entries[key] = value
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        future.set_result(value)
+        return value
+
+    def evict( self, experiment ):
+        with self.lock:
+            self.generations[experiment] = self.generations.get(experiment, 0) + 1
+            for key in [k for k in self.entries if k[0] == experiment]:
+                del self.entries[key]
+            for key in [k for k in self.pending if k[0] == experiment]:
+                del self.pending[key]
+
+    def info(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'max_entries': self.max_entries, 'hits': self.hits, 'misses': self.misses}
+
+class CachedData(Data):
+    """
+    Data whose tidied plates and RQ are kept in a shared LRU cache, so every later
+    stage reuses them. Cached frames are copied on the way out because the analysis
+    stages modify their inputs in place.
+    """
+    def __init__( self, cache, name, *args, **kwargs ):
+        super().__init__(*args, **kwargs)
+        self.cache = cache
+        self.name  = name
+
+    def cached( self, stage, compute ):
+        # Copies made by Data.query only read part of the data, so they bypass the cache
+        if self.pushdown is not None: return compute()
+        return self.cache.get_or_compute((self.name, stage), compute)
+
+    def tidy_each_experiment(self):
+        tidied = self.cached('tidy_each_experiment', super().tidy_each_experiment)
+        return [t_df.copy() for t_df in tidied]
+
+    def prepare_wells(self, tidied=None):
+        # From the cached plates rather than reading them again
+        return super().prepare_wells(self.tidy_each_experiment() if tidied is None else tidied)
+
+    def calculate_RQ(self, df=None):
+        if df is not None: return super().calculate_RQ(df)
+        return self.cached('calculate_RQ', super().calculate_RQ).copy()
+
+    def normalise_to_bio_ref(self, rq_df=None, select=None):
+        if rq_df is not None or select is not None: return super().normalise_to_bio_ref(rq_df, select)
+        norm_df, norm_df_mean = self.cached('normalise_to_bio_ref', super().normalise_to_bio_ref)
+        return norm_df.copy(), norm_df_mean.copy()
+
+# Stage name -> function of a CachedData returning a DataFrame
+STAGES = {
+    'tidy'        : lambda data: data.concat_df(data.tidy_each_experiment()),
+    'rq'          : lambda data: data.calculate_RQ(),
+    'norm_rq'     : lambda data: data.normalise_to_bio_ref()[0],
+    'norm_rq_mean': lambda data: data.normalise_to_bio_ref()[1],
+    'sem'         : lambda data: data.calculate_sd_sem(data.normalise_to_bio_ref()[0]).reset_index(),
+    'compare'     : lambda data: data.compare_treatments(),
+}
+
+# Query string filters -> column they apply to
+FILTERS = {'target': 'Target', 'age': 'Age', 'treatment': 'Treatment', 'plate': 'Plate', 'sample': 'Sample'}
+
+class AnalysisServer:
+    def __init__( self, experiments=None, max_entries=64 ):
+        self.cache       = LRUCache(max_entries)
+        self.experiments = {}
+        for name, kwargs in (experiments or {}).items():
+            self.register(name, **kwargs)
+
+    def register( self, name, **kwargs ):
+        # (Re)registering an experiment throws away anything cached for it
+        self.cache.evict(name)
+        self.experiments[name] = CachedData(self.cache, name, **kwargs)
+
+    def stage( self, stage, experiments=None, **filters ):
+        """
+        One stage for one or more experiments, with an Experiment column added and any
+        filters applied. Filter values may be lists.
+        :rtype: DataFrame
+        """
+        if stage not in STAGES: raise KeyError('Unknown stage {}, expected one of {}'.format(stage, list(STAGES)))
+        names = experiments or list(self.experiments)
+
+        frames = []
+        for name in names:
+            if name not in self.experiments: raise KeyError('Unknown experiment {}'.format(name))
+            df = self.cache.get_or_compute((name, stage), lambda: STAGES[stage](self.experiments[name]))
+            frames.append(df.assign(Experiment=name))
+        df = pd.concat(frames, sort=False, ignore_index=True) if frames else pd.DataFrame()
+
+        for key, values in filters.items():
+            column = FILTERS[key]
+            if column == 'Age' and column not in df.columns: column = 'Condition'
+            if column not in df.columns: continue
+            values = values if isinstance(values, list) else [values]
+            df = df.loc[df[column].astype(str).isin([str(v) for v in values])]
+        return df.reset_index(drop=True)
+
+    def serve( self, port=8765 ):
+        server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(self))
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+def make_handler(analysis):
+    class Handler(BaseHTTPRequestHandler):
+        def send( self, code, body, content_type='application/json' ):
+            body = body.encode()
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url   = urlparse(self.path)
+            query = parse_qs(url.query)
+            path  = url.path.strip('/')
+
+            if path == 'experiments': return self.send(200, json.dumps(list(analysis.experiments)))
+            if path == 'cache':       return self.send(200, json.dumps(analysis.cache.info()))
+
+            fmt         = query.pop('format', ['json'])[0]
+            experiments = query.pop('experiment', None)
+            unknown     = [k for k in query if k not in FILTERS]
+            if unknown: return self.send(400, json.dumps({'error': 'Unknown filters {}'.format(unknown)}))
+
+            missing = [name for name in experiments or [] if name not in analysis.experiments]
+            if path not in STAGES: return self.send(404, json.dumps({'error': 'Unknown stage {}, expected one of {}'.format(path, list(STAGES))}))
+            if missing:            return self.send(404, json.dumps({'error': 'Unknown experiments {}'.format(missing)}))
+
+            try:
+                df = analysis.stage(path, experiments, **query)
+            except Exception as e:
+                # e.g. an export that can't be parsed; the client gets the error rather than a dropped connection
+                return self.send(500, json.dumps({'error': '{}: {}'.format(type(e).__name__, e)}))
+
+            if fmt == 'csv': return self.send(200, df.to_csv(index=False), 'text/csv')
+            return self.send(200, df.to_json(orient='records'))
+
+        def do_POST(self):
+            if urlparse(self.path).path.strip('/') != 'experiments':
+                return self.send(404, json.dumps({'error': 'Not found'}))
+
+            try:
+                kwargs = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                name   = kwargs.pop('name')
+                analysis.register(name, **kwargs)
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                # Body that isn't a JSON object with a name and valid Data arguments
+                return self.send(400, json.dumps({'error': '{}: {}'.format(type(e).__name__, e)}))
+            except Exception as e:
+                return self.send(500, json.dumps({'error': '{}: {}'.format(type(e).__name__, e)}))
+            return self.send(200, json.dumps({'registered': name}))
+
+        def log_message( self, format, *args ):
+            pass
+
+    return Handler
+
+def query( stage, port=8765, **filters ):
+    """
+    Fetch a stage from a running server, e.g. query('norm_rq', target='GRIN2AA').
+    Use experiment=[...] to limit which experiments are returned.
+    :rtype: DataFrame
+    """
+    url = 'http://127.0.0.1:{}/{}?{}'.format(port, stage, urlencode(filters, doseq=True))
+    with urlopen(Request(url)) as response:
+        return pd.DataFrame(json.loads(response.read()))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve qPCR analyses from a warm in-memory cache.')
+    parser.add_argument('config', nargs='?', help='JSON file mapping experiment names to Data arguments')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max-entries', type=int, default=64, help='Number of cached stages kept in memory')
+    args = parser.parse_args()
+
+    experiments = {}
+    if args.config:
+        with open(args.config) as f: experiments = json.load(f)
+
+    AnalysisServer(experiments, args.max_entries).serve(args.port)
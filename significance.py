@@ -0,0 +1,149 @@
+import pandas as pd, numpy as np
+
+from scipy import stats
+
+#--------------------------------------------------------------------------------
+# Treatment vs control tests for every Target x Age at once
+#
+# Values for every contrast are packed into one NaN-padded (contrasts x replicates)
+# array per side, so Welch t-tests and permutation tests run as array operations
+# over all contrasts together, followed by Benjamini-Hochberg across all of them.
+
+def pack( values, groups ):
+    """
+    Arrange values into rows by group, padding short rows with NaN.
+    :param array values: One value per observation.
+    :param array groups: Integer group code (0..n_groups-1) per observation.
+    :return: (groups x max group size) array and the size of each group
+    :rtype: tuple(ndarray, ndarray)
+    """
+    groups   = np.asarray(groups)
+    n_groups = groups.max()+1 if len(groups) else 0
+    sizes    = np.bincount(groups, minlength=n_groups)
+    position = pd.Series(groups).groupby(groups).cumcount().to_numpy()
+
+    packed = np.full((n_groups, sizes.max() if len(sizes) else 0), np.nan)
+    packed[groups, position] = values
+    return packed, sizes
+
+def welch( a, b ):
+    """
+    Welch's t-test row by row on NaN-padded arrays.
+    :return: Difference in means (a-b), t, degrees of freedom and two-sided p
+    :rtype: tuple(ndarray, ndarray, ndarray, ndarray)
+    """
+    n_a, n_b = (~np.isnan(a)).sum(axis=1), (~np.isnan(b)).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m_a, m_b = np.nanmean(a, axis=1), np.nanmean(b, axis=1)
+        v_a, v_b = np.nanvar(a, axis=1, ddof=1)/n_a, np.nanvar(b, axis=1, ddof=1)/n_b
+        diff     = m_a - m_b
+        t        = diff/np.sqrt(v_a + v_b)
+        dof      = (v_a + v_b)**2/(v_a**2/(n_a-1) + v_b**2/(n_b-1))
+    p = 2*stats.t.sf(np.abs(t), dof)
+    return diff, t, dof, p
+
+def permutation( a, b, n_perm=10000, chunk=1000, seed=None ):
+    """
+    Two-sided permutation test of the difference in means, row by row on NaN-padded
+    arrays. Permutations are drawn for all rows at once, chunk permutations at a time.
+    :return: Permutation p values, (count of |diff| >= observed + 1)/(n_perm + 1)
+    :rtype: ndarray
+    """
+    rng      = np.random.default_rng(seed)
+    n_a, n_b = (~np.isnan(a)).sum(axis=1), (~np.isnan(b)).sum(axis=1)
+
+    # Pool both sides of each row, moving the padding to the end
+    pooled = np.concatenate([a, b], axis=1)
+    order  = np.argsort(np.isnan(pooled), axis=1, kind='stable')
+    pooled = np.take_along_axis(pooled, order, axis=1)
+    valid  = ~np.isnan(pooled)
+    pooled = np.where(valid, pooled, 0)
+    total  = pooled.sum(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        observed = np.abs(np.nanmean(a, axis=1) - np.nanmean(b, axis=1))
+
+    slot    = np.arange(pooled.shape[1])
+    in_a    = slot[None,:] < n_a[:,None]
+    hits    = np.zeros(len(pooled))
+    done    = 0
+    while done < n_perm:
+        n    = min(chunk, n_perm-done)
+        # Random sort keys, with padding always sorted last so it never lands in either side
+        keys = rng.random((len(pooled), n, pooled.shape[1])) + ~valid[:,None,:]
+        perm = np.take_along_axis(np.broadcast_to(pooled[:,None,:], keys.shape), np.argsort(keys, axis=2), axis=2)
+
+        sum_a = (perm*in_a[:,None,:]).sum(axis=2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            diff = sum_a/n_a[:,None] - (total[:,None]-sum_a)/n_b[:,None]
+        hits += (np.abs(diff) >= observed[:,None] - 1e-12).sum(axis=1)
+        done += n
+
+    p = (hits+1)/(n_perm+1)
+    return np.where((n_a > 0) & (n_b > 0), p, np.nan)
+
+def benjamini_hochberg(p):
+    """
+    Benjamini-Hochberg adjusted p values (q values). NaN p values are left out of the
+    correction and stay NaN.
+    :rtype: ndarray
+    """
+    p     = np.asarray(p, dtype=float)
+    q     = np.full(len(p), np.nan)
+    ok    = np.flatnonzero(~np.isnan(p))
+    order = ok[np.argsort(p[ok])]
+    m     = len(order)
+    if m == 0: return q
+
+    ranked   = p[order]*m/np.arange(1, m+1)
+    q[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1)
+    return q
+
+def compare_treatments( norm_df, cntl_grp, value='log(norm_RQ)', by=('Target', 'Age'), method='welch', n_perm=10000, seed=None ):
+    """
+    Test every non-control treatment against the control group, within each Target and
+    Age, on log2 normalised RQ.
+    :param DataFrame norm_df: First output of Data.normalise_to_bio_ref.
+    :param string cntl_grp: Treatment of the control group.
+    :param string method: 'welch' or 'permutation'.
+    :return: One row per contrast with group sizes, log2 fold change, test statistic,
+        p and Benjamini-Hochberg q
+    :rtype: DataFrame
+    """
+    by = list(by)
+    df = norm_df.loc[np.isfinite(norm_df[value].astype(float)), by + ['Treatment', value]]
+
+    treated = df.loc[df['Treatment'] != cntl_grp]
+    control = df.loc[df['Treatment'] == cntl_grp]
+
+    # One contrast per treated group that has a control group to compare with
+    contrasts = treated[by + ['Treatment']].drop_duplicates()
+    contrasts = contrasts.merge(control[by].drop_duplicates(), on=by).sort_values(by + ['Treatment']).reset_index(drop=True)
+    contrasts['Contrast'] = np.arange(len(contrasts))
+
+    a_rows = treated.merge(contrasts, on=by + ['Treatment'])
+    b_rows = control.merge(contrasts, on=by)
+    a, n_a = pack(a_rows[value].to_numpy(dtype=float), a_rows['Contrast'].to_numpy())
+    b, n_b = pack(b_rows[value].to_numpy(dtype=float), b_rows['Contrast'].to_numpy())
+
+    # Pad to the same number of rows in case the last contrasts are missing on one side
+    n = len(contrasts)
+    a = np.vstack([a, np.full((n-len(a), a.shape[1]), np.nan)]) if len(a) < n else a
+    b = np.vstack([b, np.full((n-len(b), b.shape[1]), np.nan)]) if len(b) < n else b
+
+    diff, t, dof, p = welch(a, b)
+    if method == 'permutation':
+        p = permutation(a, b, n_perm=n_perm, seed=seed)
+    elif method != 'welch':
+        raise ValueError("method must be 'welch' or 'permutation', got '{}'".format(method))
+
+    results = contrasts.drop('Contrast', axis=1)
+    results['Control']   = cntl_grp
+    results['n']         = (~np.isnan(a)).sum(axis=1)
+    results['n Control'] = (~np.isnan(b)).sum(axis=1)
+    results['log2FC']    = diff
+    results['t']         = t
+    results['df']        = dof
+    results['p']         = p
+    results['q']         = benjamini_hochberg(p)
+    return results
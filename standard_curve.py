@@ -0,0 +1,113 @@
+import pandas as pd, numpy as np
+
+#--------------------------------------------------------------------------------
+# Standard curves and absolute quantification
+#
+# The wells of a dilution series (standards of known quantity) are fitted as
+#
+#     Cq = slope*log10(quantity) + intercept
+#
+# for every Plate and Target at once. The least-squares line of a curve only needs
+# six sums (n, x, y, xx, xy, yy), so one groupby pass gives the sums of every curve
+# and the normal equations of all of them are solved together as column arithmetic.
+# Sums from different chunks of plates add up, as the partial sums in streaming.py do.
+#
+#   amplification factor   A = 10^(-1/slope)   (2 = 100% efficient, as in amplification.py)
+#   efficiency             100*(A - 1) %
+#   quantity               q = 10^((Cq - intercept)/slope)
+
+KEYS = ['Plate', 'Target']
+
+def dilution_wells( df, standards ):
+    """
+    Wells of the standards with the log10 of their known quantity as x and Cq as y.
+    Undetermined wells (Cq of 0, see Data.tidy) are left out.
+    :param DataFrame df: Tidied wells.
+    :param dict standards: Sample name -> known quantity (copies, ng or relative dilution).
+    :rtype: DataFrame
+    """
+    quantity = df['Sample'].map(pd.Series(standards, dtype=float))
+    mask     = (quantity > 0) & (df['Cq'] > 0)
+    return df.loc[mask].assign(x=np.log10(quantity[mask]), y=df.loc[mask, 'Cq'])
+
+def curve_sums( df, standards, by=KEYS ):
+    """
+    The sums needed to fit the standard curve of every group of by.
+    :rtype: DataFrame
+    """
+    wells = dilution_wells(df, standards)
+    wells = wells.assign(xx=wells['x']**2, xy=wells['x']*wells['y'], yy=wells['y']**2)
+    sums  = wells.groupby(by)[['x', 'y', 'xx', 'xy', 'yy']].sum()
+    sums.insert(0, 'n', wells.groupby(by).size())
+    return sums
+
+def merge_sums(sums):
+    # Curve sums add up, whichever chunks of plates they came from
+    sums = [s for s in sums if s is not None]
+    if len(sums) == 1: return sums[0]
+    return pd.concat(sums).groupby(level=list(sums[0].index.names)).sum()
+
+def centred(sums):
+    # Sums of squares and products about the means of each curve
+    n = sums['n']
+    return sums['xx'] - sums['x']**2/n, sums['xy'] - sums['x']*sums['y']/n, sums['yy'] - sums['y']**2/n
+
+def fit(sums):
+    """
+    Slope, intercept, R^2, amplification factor and efficiency of every standard curve.
+    Curves with fewer than two dilutions come back as NaN.
+    :param DataFrame sums: Output of curve_sums or merge_sums.
+    :rtype: DataFrame
+    """
+    sxx, sxy, syy = centred(sums)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (sxy/sxx).where(sxx > 0)
+        amp   = 10**(-1/slope)
+
+        curves = pd.DataFrame({
+                               'Slope'        : slope,
+                               'Intercept'    : (sums['y'] - slope*sums['x'])/sums['n'],
+                               'R2'           : sxy**2/(sxx*syy),
+                               'Amplification': amp,
+                               'Efficiency %' : 100*(amp - 1),
+                               'n'            : sums['n'],
+                              }, index=sums.index)
+    return curves
+
+def fit_standard_curves( df, standards, by=KEYS ):
+    """
+    Fit the standard curve of every Plate and Target (or other groups given by by).
+    :param DataFrame df: Tidied wells.
+    :param dict standards: Sample name -> known quantity.
+    :rtype: DataFrame
+    """
+    return fit(curve_sums(df, standards, by))
+
+def target_amplification(sums):
+    """
+    One amplification factor per Target, from a common slope fitted over all of its
+    curves. Each curve (e.g. each plate) keeps its own intercept, so plate-to-plate
+    offsets don't bias the slope. Targets without a usable curve are left out.
+    :param DataFrame sums: Curve sums with Target in the index.
+    :rtype: Series
+    """
+    sxx, sxy, _ = centred(sums)
+    pooled      = pd.DataFrame({'sxx': sxx, 'sxy': sxy}).groupby(level='Target').sum()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        amp = 10**(-pooled['sxx']/pooled['sxy'])
+    return amp.where(pooled['sxx'] > 0).dropna().rename('Amplification')
+
+def quantify( df, curves, cq='Mean Cq' ):
+    """
+    Read the quantity of every row of df off the standard curve of its group, e.g. the
+    Mean Cq of every sample from engine.mean_cq. Undetermined Cq gives no quantity.
+    :param DataFrame curves: Output of fit, indexed by the groups it was fitted on.
+    :rtype: DataFrame
+    """
+    joined = df.join(curves[['Slope', 'Intercept']], on=list(curves.index.names))
+    log_q  = (joined[cq] - joined['Intercept'])/joined['Slope']
+
+    df = df.copy()
+    df['log10(Quantity)'] = log_q.where(df[cq] > 0)
+    df['Quantity']        = 10**df['log10(Quantity)']
+    return df
@@ -0,0 +1,75 @@
+import pandas as pd, numpy as np
+
+import engine
+
+#--------------------------------------------------------------------------------
+# Out-of-core RQ for archives too big to hold as wells
+#
+# Plates are tidied a chunk at a time and each chunk is reduced to partial sums
+# (count, sum and sum of squares of Cq) per sample. Partials from different
+# chunks merge by addition, so only one chunk of wells is ever in memory. The
+# merged partials give the same Mean Cq, Cq Var and n as engine.mean_cq, and
+# the rest of the chain runs on those through engine.py.
+
+KEYS = ['Condition', 'Sample', 'Bio Rep', 'Plate', 'Treatment', 'Target']
+
+def partial_sums(df):
+    """
+    Count, sum and sum of squares of Cq per sample of a chunk of tidied wells.
+    :rtype: DataFrame
+    """
+    sums = df.assign(Cq2=df['Cq']**2).groupby(KEYS).agg({'Cq': ['count', 'sum'], 'Cq2': 'sum'})
+    sums.columns = ['n', 'sum', 'sum2']
+    return sums
+
+def merge_partials(partials):
+    # Partial sums add up, whichever chunks they came from
+    partials = [p for p in partials if p is not None]
+    if len(partials) == 1: return partials[0]
+    return pd.concat(partials).groupby(level=KEYS).sum()
+
+def mean_cq_from_partials(partials):
+    """
+    Mean, variance and count of the tech reps of every sample from merged partial sums.
+    Same frame as engine.mean_cq.
+    :rtype: DataFrame
+    """
+    n = partials['n']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var = (partials['sum2'] - partials['sum']**2/n)/(n-1)
+
+    mean_cq_df = pd.DataFrame({'Mean Cq': partials['sum']/n, 'Cq Var': np.maximum(var, 0).where(n > 1), 'n': n}).reset_index()
+    mean_cq_df = mean_cq_df.rename(columns={'Condition': 'Age'})
+    mean_cq_df['Plate'] = mean_cq_df['Plate'].astype(int)
+
+    columns = ['Sample', 'Bio Rep', 'Target', 'Age', 'Mean Cq', 'Treatment', 'Plate', 'Cq Var', 'n']
+    return mean_cq_df[columns].sort_values(['Plate', 'Age', 'Target', 'Treatment'], kind='mergesort')
+
+def iter_chunks( data, plates_per_chunk=8 ):
+    """
+    Tidied wells of a Data object, plates_per_chunk plates at a time, after melt curve QC.
+    :rtype: generator of DataFrame
+    """
+    plates = data.plate_indices()
+    for start in range(0, len(plates), plates_per_chunk):
+        yield data.concat_df(data.exclude_failed_wells(data.tidy_plate(i)) for i in plates[start:start+plates_per_chunk])
+
+def stream_mean_cq( data, plates_per_chunk=8 ):
+    """
+    Mean Cq of every sample of a Data object, never holding more than one chunk of wells.
+    :rtype: DataFrame
+    """
+    partials = None
+    for chunk in iter_chunks(data, plates_per_chunk):
+        partials = merge_partials([partials, partial_sums(chunk)])
+    return mean_cq_from_partials(partials)
+
+def calculate_RQ( data, plates_per_chunk=8 ):
+    """
+    Same as engine.calculate_RQ on all the plates of data, computed chunk by chunk.
+    :rtype: DataFrame
+    """
+    if data.calibrate:
+        raise ValueError('Plate calibration needs every plate at once and is not available when streaming.')
+    mean_cq_df = data.drop_standards(stream_mean_cq(data, plates_per_chunk))
+    return engine.relative_quantity(mean_cq_df, data.cntl_grp, amplification=data.amplification_factors())
@@ -0,0 +1,52 @@
+import pandas as pd, numpy as np
+import pytest
+
+import amplification
+
+def curves( n_amplified=184, n_flat=200, n_cycles=40, seed=0 ):
+    # Sigmoid curves crossing a fluorescence of 100 at a known cycle, then flat no-template
+    # wells, all on a drifting background with noise
+    rng    = np.random.default_rng(seed)
+    cycles = np.arange(1, n_cycles+1)
+    n      = n_amplified + n_flat
+
+    true_cq = rng.uniform(14, 33, n_amplified)
+    plateau = rng.uniform(15000, 25000, (n_amplified, 1))
+    x       = 100/1.9**true_cq[:,None]*1.9**cycles[None,:]
+
+    F = rng.uniform(800, 1200, (n, 1)) + rng.normal(0, 0.5, (n, 1))*cycles[None,:] + rng.normal(0, 8, (n, n_cycles))
+    F[:n_amplified] += plateau*x/(plateau + x)
+    return F, true_cq
+
+@pytest.mark.parametrize('method', ['threshold', 'sdm'])
+@pytest.mark.parametrize('seed', range(3))
+def test_amplified_wells_are_called_and_flat_wells_are_not(method, seed):
+    F, true_cq = curves(seed=seed)
+    cq         = amplification.call_cq(F, method=method)['Cq'].to_numpy()
+    called, flat = cq[:len(true_cq)], cq[len(true_cq):]
+
+    assert np.isfinite(called).all()
+    assert np.isnan(flat).all()
+    # Both methods track the true Cq up to a constant offset, the threshold method less
+    # closely for late wells, where an error in the baseline slope has had longest to grow
+    error = np.abs(called - true_cq - np.median(called - true_cq))
+    assert np.percentile(error, 90) < 1
+
+def test_sdm_cq_stays_within_the_run():
+    F, _ = curves(n_amplified=50, n_flat=0, seed=3)
+    cq   = amplification.call_cq(F, method='sdm')['Cq'].to_numpy()
+    assert (cq >= 1).all() and (cq <= F.shape[1]).all()
+
+def test_noise_spike_is_not_a_cq():
+    F, _ = curves(n_amplified=0, n_flat=20)
+    F[0, 25] += 5000
+    assert amplification.call_cq(F)['Cq'].isna().all()
+
+def test_wells_missing_from_the_curve_file_keep_their_cq():
+    export = pd.DataFrame({'Position': ['A1', 'A2', 'A3'], 'Cq': [21.0, 35.0, 27.0]})
+    calls  = pd.DataFrame({'Cq': [20.5, np.nan], 'Efficiency': [1.9, np.nan], 'R2': [0.99, np.nan]})
+    df     = amplification.replace_cq(export, np.array(['A1', 'A2']), calls)
+
+    assert df['Cq'].iloc[0] == 20.5
+    assert np.isnan(df['Cq'].iloc[1])
+    assert df['Cq'].iloc[2] == 27.0
@@ -0,0 +1,35 @@
+import pandas as pd, numpy as np
+import pytest
+
+import calibration
+
+OFFSETS = {1: 0.0, 2: 1.5, 3: -0.7, 4: 2.0}
+
+def control_wells( offsets=OFFSETS, unlinked=() ):
+    # Tech reps of two control samples on every plate, shifted by the plate's offset.
+    # Plates in unlinked only have a control sample that no other plate has.
+    rng  = np.random.default_rng(0)
+    rows = []
+    for plate, offset in offsets.items():
+        samples = {'Z': 32.0} if plate in unlinked else {'A': 20.0, 'B': 23.0}
+        for sample, cq in samples.items():
+            for _ in range(3):
+                rows.append({'Sample': sample, 'Target': 'GRIN2AA', 'Treatment': 'Non Gravel', 'Plate': plate,
+                             'Cq': cq + offset + rng.normal(0, 1e-3)})
+    return pd.DataFrame(rows)
+
+def test_known_offsets_are_recovered():
+    offsets = calibration.plate_offsets(control_wells(), cntl_grp='Non Gravel')
+    assert offsets[list(OFFSETS)].to_numpy() == pytest.approx(list(OFFSETS.values()), abs=0.01)
+
+def test_calibrated_plates_share_a_scale():
+    calibrated, _ = calibration.calibrate(control_wells(), cntl_grp='Non Gravel')
+    means = calibrated.groupby(['Sample', 'Plate'])['Cq'].mean()
+    assert means['A'].to_numpy() == pytest.approx(20.0, abs=0.01)
+    assert means['B'].to_numpy() == pytest.approx(23.0, abs=0.01)
+
+def test_unlinked_plate_is_pinned_and_warned_about():
+    with pytest.warns(UserWarning, match=r'Plates \[4\]'):
+        offsets = calibration.plate_offsets(control_wells(unlinked=[4]), cntl_grp='Non Gravel')
+    assert offsets[4] == 0
+    assert offsets[[1, 2, 3]].to_numpy() == pytest.approx([0.0, 1.5, -0.7], abs=0.01)
@@ -0,0 +1,45 @@
+import pandas as pd
+import pytest
+
+from qPCR import Data
+from equivalence import load_recorded, rename_samples, write_exports, positions, compare, FrameData
+
+REF_GENE, BIO_REF, CNTL_GRP = 'BACTIN', ['3', 'GRIN2AA'], 'Non Gravel'
+# Each normalised sample is identified by these, whatever it is called
+KEYS = ['Target', 'Age', 'Treatment', 'Bio Rep', 'Plate']
+
+def assert_same_norm_RQ( expected, actual ):
+    bad = compare(expected[0], actual[0], KEYS, ['norm_RQ', 'log(norm_RQ)'])
+    assert len(bad) == 0, bad.to_string()
+    bad = compare(expected[1], actual[1], ['Target', 'Age', 'Treatment'], ['norm_RQ'])
+    assert len(bad) == 0, bad.to_string()
+
+@pytest.fixture
+def plates():
+    return load_recorded('test.csv')
+
+def test_renamed_samples_give_the_same_norm_RQ(plates):
+    # Names that don't sort by bio rep, e.g. X7 for bio rep 1 and X2 for bio rep 2
+    expected = FrameData(plates, REF_GENE, BIO_REF, CNTL_GRP).normalise_to_bio_ref()
+    actual   = FrameData(rename_samples(plates), REF_GENE, BIO_REF, CNTL_GRP).normalise_to_bio_ref()
+    assert_same_norm_RQ(expected, actual)
+
+def test_samples_named_by_a_layout_give_the_same_norm_RQ(plates, tmp_path):
+    (tmp_path / 'encoded').mkdir()
+    (tmp_path / 'layout').mkdir()
+    names    = write_exports(plates, tmp_path / 'encoded')
+    expected = Data(str(tmp_path / 'encoded') + '/', names, REF_GENE, BIO_REF, CNTL_GRP).normalise_to_bio_ref()
+
+    # Sample names say nothing, age and bio rep come from the layout only
+    renamed = rename_samples(plates)
+    write_exports(renamed, tmp_path / 'layout')
+    layout  = pd.concat([pd.DataFrame({
+                                        'Plate'    : i+1,
+                                        'Position' : positions(len(plate)),
+                                        'Condition': plate['Condition'].to_numpy(),
+                                        'Bio Rep'  : plate['Bio Rep'].to_numpy(),
+                                        }) for i, plate in enumerate(renamed)])
+    actual  = Data(str(tmp_path / 'layout') + '/', names, REF_GENE, BIO_REF, CNTL_GRP, layout=layout).normalise_to_bio_ref()
+
+    assert expected[0]['norm_RQ'].notna().all()
+    assert_same_norm_RQ(expected, actual)
@@ -0,0 +1,43 @@
+import pandas as pd, numpy as np
+import pytest
+
+from qPCR import Data
+from equivalence import load_recorded, write_exports, compare
+
+REF_GENE, BIO_REF, CNTL_GRP = 'BACTIN', ['3', 'GRIN2AA'], 'Non Gravel'
+STANDARDS = {'STD_1': 1000, 'STD_2': 100, 'STD_3': 10, 'STD_4': 1}
+
+def with_standards(plates):
+    # A dilution series of every target of every plate, amplifying at 1.9 per cycle
+    rng  = np.random.default_rng(0)
+    with_std = []
+    for plate in plates:
+        rows = [{'Sample': sample, 'Bio Rep': '1', 'Target': target, 'Cq': 32 - np.log(quantity)/np.log(1.9) + rng.normal(0, 0.1),
+                 'Cq Mean': np.nan, 'Replicate Group': 'S', 'Condition': 'STD', 'Treatment': 'Standard', 'Plate': plate['Plate'].iloc[0]}
+                for target in plate['Target'].unique() for sample, quantity in STANDARDS.items() for _ in range(2)]
+        with_std.append(pd.concat([plate, pd.DataFrame(rows)], ignore_index=True))
+    return with_std
+
+@pytest.fixture(scope='module')
+def exports(tmp_path_factory):
+    path = tmp_path_factory.mktemp('plates')
+    return str(path) + '/', write_exports(with_standards(load_recorded('test.csv')), path)
+
+FILTERS = [{'target': 'GRIN2AB'}, {'age': '5'}, {'treatment': 'Non Gravel'}, {'treatment': 'Gravel', 'age': ['3', '7']}]
+
+@pytest.mark.parametrize('filters', FILTERS)
+@pytest.mark.parametrize('efficiency', [None, 'standards'])
+@pytest.mark.parametrize('engine', ['loop', 'vectorized', 'streaming'])
+def test_query_is_the_filtered_full_analysis(exports, engine, efficiency, filters):
+    data  = Data(*exports, REF_GENE, BIO_REF, CNTL_GRP, engine=engine, standards=STANDARDS, efficiency=efficiency)
+    query = data.query(**filters)
+
+    expected, actual = query.select(data.calculate_RQ()), query.calculate_RQ()
+    bad = compare(expected, actual, ['Sample', 'Target', 'Plate'], ['RQ'])
+    assert len(bad) == 0, bad.to_string()
+
+    full, pruned = data.normalise_to_bio_ref(), query.normalise_to_bio_ref()
+    bad = compare(query.select(full[0]), pruned[0], ['Sample', 'Target', 'Plate'], ['norm_RQ'])
+    assert len(bad) == 0, bad.to_string()
+    bad = compare(query.select(full[1]), pruned[1], ['Target', 'Age', 'Treatment'], ['norm_RQ'])
+    assert len(bad) == 0, bad.to_string()
@@ -0,0 +1,96 @@
+import time, threading
+import pytest
+
+from server import LRUCache
+
+def in_threads( n, target ):
+    # Run target in n threads at once, returning what each returned or raised
+    results = [None]*n
+    def run(i):
+        try:
+            results[i] = target()
+        except Exception as e:
+            results[i] = e
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for t in threads: t.start()
+    return threads, results
+
+def wait_for_waiters( cache, n ):
+    # Until n requests have found the entry being computed; each counts a hit, then waits
+    while cache.hits < n: time.sleep(0.001)
+
+def test_concurrent_requests_compute_once():
+    cache, calls, release = LRUCache(), [], threading.Event()
+    def compute():
+        calls.append(1)
+        release.wait()
+        return 'rq'
+
+    threads, results = in_threads(4, lambda: cache.get_or_compute(('A', 'rq'), compute))
+    while ('A', 'rq') not in cache.pending: time.sleep(0.001)
+    wait_for_waiters(cache, 3)
+    release.set()
+    for t in threads: t.join()
+
+    assert len(calls) == 1
+    assert results == ['rq']*4
+    assert cache.info()['misses'] == 1
+
+def test_other_entries_are_not_held_up():
+    cache, release = LRUCache(), threading.Event()
+    cache.get_or_compute(('A', 'rq'), lambda: 'a')
+
+    threads, _ = in_threads(1, lambda: cache.get_or_compute(('C', 'rq'), lambda: release.wait() and 'c'))
+    while ('C', 'rq') not in cache.pending: time.sleep(0.001)
+    hit, result = in_threads(1, lambda: cache.get_or_compute(('A', 'rq'), lambda: 'recomputed'))
+    hit[0].join(timeout=5)
+    blocked = hit[0].is_alive()
+    release.set()
+    for t in threads + hit: t.join()
+
+    assert not blocked
+    assert result == ['a']
+
+def test_exception_reaches_every_waiter():
+    cache, release = LRUCache(), threading.Event()
+    def compute():
+        release.wait()
+        raise RuntimeError('bad export')
+
+    threads, results = in_threads(3, lambda: cache.get_or_compute(('B', 'rq'), compute))
+    while ('B', 'rq') not in cache.pending: time.sleep(0.001)
+    wait_for_waiters(cache, 2)
+    release.set()
+    for t in threads: t.join()
+
+    assert all(isinstance(r, RuntimeError) and str(r) == 'bad export' for r in results)
+    # Nothing is cached, so the next request tries again
+    assert ('B', 'rq') not in cache.entries and ('B', 'rq') not in cache.pending
+    assert cache.get_or_compute(('B', 'rq'), lambda: 'fixed') == 'fixed'
+
+def test_entry_of_reregistered_experiment_is_not_stored():
+    cache, started, release = LRUCache(), threading.Event(), threading.Event()
+    def compute():
+        started.set()
+        release.wait()
+        return 'old'
+
+    threads, results = in_threads(1, lambda: cache.get_or_compute(('D', 'rq'), compute))
+    started.wait()
+    cache.evict('D')
+    release.set()
+    for t in threads: t.join()
+
+    assert results == ['old']
+    assert ('D', 'rq') not in cache.entries
+    assert cache.get_or_compute(('D', 'rq'), lambda: 'new') == 'new'
+
+def test_least_recently_used_entries_are_evicted():
+    cache = LRUCache(max_entries=2)
+    cache.get_or_compute(('A', 'rq'), lambda: 'a')
+    cache.get_or_compute(('B', 'rq'), lambda: 'b')
+    cache.get_or_compute(('A', 'rq'), lambda: pytest.fail('A should be cached'))
+    cache.get_or_compute(('C', 'rq'), lambda: 'c')
+
+    assert list(cache.entries) == [('A', 'rq'), ('C', 'rq')]
+    assert cache.info() == {'entries': 2, 'max_entries': 2, 'hits': 1, 'misses': 3}